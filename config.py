@@ -1,7 +1,7 @@
 # config.py
 import os
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from cryptography.fernet import Fernet
 
@@ -17,6 +17,8 @@ class Settings(BaseSettings):
     DEBUG: bool = False
     # --- Настройки базы данных ---
     DATABASE_URL: str
+    # Прямое подключение для LISTEN/NOTIFY (transaction pooler не поддерживает LISTEN)
+    DATABASE_LISTEN_URL: Optional[str] = None
     # --- Настройки безопасности и JWT ---
     SECRET_KEY: str
     ENCRYPTION_KEY: str
@@ -29,6 +31,37 @@ class Settings(BaseSettings):
     ALLEGRO_REDIRECT_URI: str
     ALLEGRO_API_URL: str = "https://api.allegro.pl"
     ALLEGRO_AUTH_URL: str = "https://allegro.pl/auth/oauth"
+    ALLEGRO_TOKEN_REFRESH_MARGIN_SECONDS: int = 120
+    TOKEN_CACHE_MAXSIZE: int = 10000
+    TOKEN_CACHE_TTL_SECONDS: int = 3600
+    # --- Лимиты запросов к Allegro ---
+    ALLEGRO_RATE_LIMIT_PER_SECOND: float = 100.0
+    ALLEGRO_RATE_LIMIT_BURST: int = 100
+    ALLEGRO_ACCOUNT_RATE_LIMIT_PER_SECOND: float = 5.0
+    ALLEGRO_ACCOUNT_RATE_LIMIT_BURST: int = 10
+    ALLEGRO_RATE_LIMIT_MAX_RETRIES: int = 3
+    ALLEGRO_RETRY_AFTER_DEFAULT_SECONDS: float = 1.0
+    # Redis для общего состояния лимитера между процессами (если не задан - лимиты на процесс)
+    ALLEGRO_RATE_LIMIT_REDIS_URL: Optional[str] = None
+    # --- Повторы и автоматы для запросов к Allegro ---
+    ALLEGRO_RETRY_MAX_ATTEMPTS: int = 3
+    ALLEGRO_RETRY_BASE_DELAY_SECONDS: float = 0.5
+    ALLEGRO_RETRY_MAX_DELAY_SECONDS: float = 8.0
+    ALLEGRO_BREAKER_FAILURE_THRESHOLD: int = 5
+    ALLEGRO_BREAKER_RESET_SECONDS: float = 30.0
+    # --- Фоновое обновление токенов ---
+    TOKEN_REFRESH_JOB_INTERVAL_MINUTES: int = 10
+    TOKEN_REFRESH_WINDOW_MINUTES: int = 30
+    TOKEN_REFRESH_PAGE_SIZE: int = 200
+    TOKEN_REFRESH_CONCURRENCY: int = 10
+    TOKEN_REFRESH_SPREAD_SECONDS: float = 60.0
+    # --- Пул HTTP-соединений к Allegro ---
+    ALLEGRO_HTTP2: bool = True
+    ALLEGRO_HTTP_MAX_CONNECTIONS: int = 100
+    ALLEGRO_HTTP_MAX_KEEPALIVE: int = 20
+    ALLEGRO_HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    ALLEGRO_HTTP_TIMEOUT: float = 15.0
+    ALLEGRO_HTTP_CONNECT_TIMEOUT: float = 5.0
     # --- Настройки фронтенда ---
     FRONTEND_URL: str
     # --- Настройки Supabase ---
@@ -46,6 +79,51 @@ class Settings(BaseSettings):
         "expired": 0
     }
     MAXI_EMPLOYEE_LIMIT: int = 10
+    # --- Настройки воркера ---
+    WORKER_CONCURRENCY: int = 1
+    WORKER_PROCESSES: int = 0  # 0 - по числу ядер
+    WORKER_USE_UVLOOP: bool = False
+    WORKER_SHUTDOWN_TIMEOUT: int = 25
+    WORKER_CLAIM_BATCH_SIZE: int = 10
+    WORKER_STATUS_FLUSH_INTERVAL: float = 1.0
+    WORKER_POLL_MIN_INTERVAL: float = 1.0
+    WORKER_POLL_MAX_INTERVAL: float = 60.0
+    # --- Адаптивное расписание опроса аккаунтов ---
+    TASK_MIN_INTERVAL_SECONDS: int = 60
+    TASK_MAX_INTERVAL_SECONDS: int = 900
+    TASK_INTERVAL_BACKOFF: float = 1.5
+    # --- Автоответчик ---
+    AUTO_RESPONDER_LOOKBACK_HOURS: int = 72
+    AUTO_RESPONDER_MAX_PAGES: int = 10
+    AUTO_RESPONDER_CHECK_CONCURRENCY: int = 5
+    # --- Outbox автоответов ---
+    AUTO_REPLY_OUTBOX_BATCH_SIZE: int = 50
+    AUTO_REPLY_OUTBOX_POLL_INTERVAL: float = 5.0
+    AUTO_REPLY_OUTBOX_LEASE_SECONDS: int = 120
+    AUTO_REPLY_OUTBOX_MAX_ATTEMPTS: int = 5
+    AUTO_REPLY_OUTBOX_SEND_CONCURRENCY: int = 5
+    AUTO_REPLY_OUTBOX_RETRY_BASE_SECONDS: int = 30
+    AUTO_REPLY_OUTBOX_RETRY_MAX_SECONDS: int = 1800
+    # --- Push-уведомления ---
+    NOTIFICATION_BATCH_SIZE: int = 500
+    NOTIFICATION_FLUSH_INTERVAL: float = 1.0
+    NOTIFICATION_QUEUE_MAXSIZE: int = 10000
+    PUSH_THROTTLE_SECONDS: int = 60
+    # --- Хранение истории ---
+    AUTO_REPLY_LOG_RETENTION_DAYS: int = 30
+    MESSAGE_METADATA_RETENTION_DAYS: int = 90
+    AUTO_REPLY_OUTBOX_RETENTION_DAYS: int = 14
+    RETENTION_BATCH_SIZE: int = 5000
+    RETENTION_BATCH_PAUSE_SECONDS: float = 0.2
+    # --- Локальная копия диалогов ---
+    MIRROR_MAX_AGE_SECONDS: int = 1200
+    MIRROR_FULL_SYNC_MAX_PAGES: int = 50
+    MIRROR_ISSUES_SYNC_INTERVAL_SECONDS: int = 600
+    # --- Аренда задач и повторы ---
+    TASK_LEASE_SECONDS: int = 120
+    TASK_RETRY_BASE_SECONDS: int = 30
+    TASK_RETRY_MAX_SECONDS: int = 3600
+    WORKER_REAPER_INTERVAL: int = 60
 settings = Settings()
 
 def model_post_init(self, __context):
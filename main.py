@@ -10,9 +10,14 @@ from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from schemas.api import APIResponse
-from sqlalchemy import text
-from routers import auth, allegro, conversations, webhooks, teams, users
-from services.auto_responder_service import AutoResponderService
+from routers import auth, allegro, conversations, webhooks, teams, users, search
+from services.task_queue_service import TaskQueueService
+from services.http_client import init_http_client, close_http_client
+from services.token_refresh_service import TokenRefreshService
+from services.retention_service import RetentionService
+from services.allegro_resilience import circuit_breakers
+from services.allegro_rate_limiter import allegro_rate_limiter
+from utils.security import token_cache
 from config import settings
 from utils.rate_limiter import limiter
 from fastapi_csrf_protect import CsrfProtect
@@ -46,29 +51,12 @@ async def run_task_producer():
     logger.info("Планировщик запускает задачу 'Производителя'...")
     db_session = AsyncSessionLocal()
     try:
-        result = await db_session.execute(text("SELECT id FROM allegro_accounts;"))
-        account_ids = []
-        for raw_id in result.scalars().all():
-            try:
-                account_ids.append(int(raw_id))
-            except (ValueError, TypeError):
-                logger.warning(f"Не удалось преобразовать ID аккаунта в число: {raw_id}. Пропускаем.")
-                continue
-
-        if not account_ids:
-            logger.info("Нет аккаунтов для обработки.")
-            return
-
-        for acc_id in account_ids:
-            insert_stmt = text("""
-                INSERT INTO task_queue (allegro_account_id, status)
-                VALUES (:acc_id, 'pending')
-                ON CONFLICT (allegro_account_id) DO NOTHING;
-            """)
-            await db_session.execute(insert_stmt, {"acc_id": acc_id})
-
+        queue = TaskQueueService(db_session)
+        inserted = await queue.enqueue_all_accounts()
+        if inserted:
+            await queue.notify()
         await db_session.commit()
-        logger.info(f"Добавлено {len(account_ids)} задач в очередь.")
+        logger.info(f"Очередь задач обновлена: добавлено {inserted}.", inserted=inserted)
 
     except Exception as e:
         logger.error(f"Ошибка в 'Производителе' задач: {e}", exc_info=True)
@@ -76,42 +64,58 @@ async def run_task_producer():
         await db_session.close()
 
 
+async def run_token_refresh_task():
+    logger.info("Планировщик запускает фоновое обновление токенов Allegro...")
+    try:
+        stats = await TokenRefreshService().refresh_expiring_tokens()
+        logger.info(f"Фоновое обновление токенов завершено: обновлено {stats['refreshed']}, "
+                    f"ошибок {stats['failed']}, уже обновлены другими {stats['skipped']}.", **stats)
+    except Exception as e:
+        logger.error(f"Ошибка при фоновом обновлении токенов: {e}", exc_info=True)
+
+
 async def run_cleanup_task():
     logger.info("Планировщик запускает задачу очистки логов...")
-    db_session = AsyncSessionLocal()
     try:
-        service = AutoResponderService(db=db_session)
-        await service.cleanup_old_logs()
+        await RetentionService().purge_auto_reply_log()
     except Exception as e:
         logger.error(f"Ошибка при очистке логов: {e}", exc_info=True)
-    finally:
-        await db_session.close()
 
 async def run_cleanup_metadata_task():
     logger.info("Планировщик запускает задачу очистки метаданных...")
-    db_session = AsyncSessionLocal()
     try:
-        service = AutoResponderService(db=db_session)
-        await service.cleanup_old_message_metadata()
+        await RetentionService().purge_message_metadata()
     except Exception as e:
         logger.error(f"Ошибка при очистке метаданных: {e}", exc_info=True)
-    finally:
-        await db_session.close()
+
+async def run_cleanup_outbox_task():
+    logger.info("Планировщик запускает задачу очистки outbox автоответов...")
+    try:
+        await RetentionService().purge_auto_reply_outbox()
+    except Exception as e:
+        logger.error(f"Ошибка при очистке outbox автоответов: {e}", exc_info=True)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     from models.database import create_tables
     #await create_tables()
+    await init_http_client()
 
     scheduler.add_job(run_task_producer, 'interval', minutes=5, id="task_producer_job")
-    scheduler.add_job(run_cleanup_task, 'cron', hour=3, minute=0, id="cleanup_job")
-    scheduler.add_job(run_cleanup_metadata_task, 'cron', hour=3, minute=30, id="cleanup_metadata_job")
+    scheduler.add_job(run_token_refresh_task, 'interval', minutes=settings.TOKEN_REFRESH_JOB_INTERVAL_MINUTES,
+                      id="token_refresh_job", max_instances=1)
+    scheduler.add_job(run_cleanup_task, 'cron', hour=3, minute=0, id="cleanup_job", max_instances=1)
+    scheduler.add_job(run_cleanup_metadata_task, 'cron', hour=3, minute=30, id="cleanup_metadata_job",
+                      max_instances=1)
+    scheduler.add_job(run_cleanup_outbox_task, 'cron', hour=4, minute=0, id="cleanup_outbox_job",
+                      max_instances=1)
     scheduler.start()
     logger.info("Планировщик задач запущен")
     yield
     scheduler.shutdown()
     logger.info("Планировщик задач остановлен")
+    await close_http_client()
 
 
 app = FastAPI(
@@ -194,6 +198,7 @@ app.include_router(conversations.router)
 app.include_router(webhooks.router)
 app.include_router(teams.router)
 app.include_router(users.router)
+app.include_router(search.router)
 
 @app.get("/api/csrf-token", response_model=APIResponse[dict])
 def get_csrf_token(csrf_protect: CsrfProtect = Depends()):
@@ -212,4 +217,15 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint для мониторинга."""
-    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
\ No newline at end of file
+    return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
+
+
+@app.get("/health/allegro")
+async def allegro_health_check():
+    """Состояние интеграции с Allegro для мониторинга: автоматы, повторы, лимитер, кеш токенов."""
+    return {
+        "circuit_breakers": circuit_breakers.stats(),
+        "rate_limiter": allegro_rate_limiter.stats(),
+        "token_cache": token_cache.stats(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
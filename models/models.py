@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Text, ForeignKey, Boolean
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -87,4 +88,65 @@ class TaskQueue(Base):
     allegro_account_id = Column(Integer, ForeignKey('allegro_accounts.id', ondelete="CASCADE"), unique=True, nullable=False)
     status = Column(String, default='pending', index=True) 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    processed_at = Column(DateTime(timezone=True), nullable=True)
\ No newline at end of file
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+    next_run_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    poll_interval_seconds = Column(Integer, default=300, server_default="300", nullable=False)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, default=0, server_default="0", nullable=False)
+
+class AccountSyncState(Base):
+    __tablename__ = 'account_sync_state'
+    allegro_account_id = Column(Integer, ForeignKey('allegro_accounts.id', ondelete="CASCADE"), primary_key=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    last_thread_ids = Column(ARRAY(String), nullable=False, default=list, server_default="{}")
+    threads_synced_at = Column(DateTime(timezone=True), nullable=True)
+    threads_covered_since = Column(DateTime(timezone=True), nullable=True)
+    threads_total_count = Column(Integer, nullable=True)
+    issues_synced_at = Column(DateTime(timezone=True), nullable=True)
+    issues_covered_since = Column(DateTime(timezone=True), nullable=True)
+    issues_total_count = Column(Integer, nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class AutoReplyOutbox(Base):
+    __tablename__ = 'auto_reply_outbox'
+    id = Column(BigInteger, primary_key=True)
+    allegro_account_id = Column(Integer, ForeignKey('allegro_accounts.id', ondelete="CASCADE"), nullable=False)
+    thread_id = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    idempotency_key = Column(String, unique=True, nullable=False)
+    status = Column(String, default='pending', server_default='pending', nullable=False)
+    attempts = Column(Integer, default=0, server_default="0", nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+class PushThrottle(Base):
+    __tablename__ = 'push_throttle'
+    fcm_token = Column(String, primary_key=True)
+    last_sent_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    suppressed_count = Column(Integer, default=0, server_default="0", nullable=False)
+
+class AllegroConversation(Base):
+    __tablename__ = 'allegro_conversations'
+    allegro_account_id = Column(Integer, ForeignKey('allegro_accounts.id', ondelete="CASCADE"), primary_key=True)
+    kind = Column(String, primary_key=True)  # thread или issue
+    id = Column(String, primary_key=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    read = Column(Boolean, nullable=True)
+    raw = Column(JSONB, nullable=False)
+    synced_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    messages_synced_at = Column(DateTime(timezone=True), nullable=True)
+
+class AllegroMessageMirror(Base):
+    __tablename__ = 'allegro_messages'
+    allegro_account_id = Column(Integer, ForeignKey('allegro_accounts.id', ondelete="CASCADE"), primary_key=True)
+    id = Column(String, primary_key=True)
+    conversation_kind = Column(String, nullable=False)
+    conversation_id = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=True)
+    author_login = Column(String, nullable=True)
+    text = Column(Text, nullable=True)
+    raw = Column(JSONB, nullable=False)
+    synced_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -1,13 +1,20 @@
 # routers/conversations.py
+import asyncio
+import base64
+import heapq
+import itertools
+import json
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, status, Query, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from schemas.message import MessageCreate
 from schemas.api import APIResponse
-from services.allegro_client import AllegroClient
+from services.allegro_client import AllegroClient, MESSAGES_PAGE_LIMIT, parse_allegro_datetime
+from services.conversation_mirror_service import ConversationMirrorService, THREAD, ISSUE
 from utils.dependencies import get_authorized_allegro_account
 from models.models import AllegroAccount
-from models.database import get_db
-from datetime import datetime
+from models.database import get_db, AsyncSessionLocal
+from datetime import datetime, timezone
 from pydantic import BaseModel
 from schemas.allegro import AllegroAccountSettingsUpdate, AllegroAccountOut
 from utils.rate_limiter import limiter
@@ -19,6 +26,71 @@ class AttachmentDeclare(BaseModel):
 
 router = APIRouter(prefix="/api/allegro", tags=["Allegro Actions"])
 
+_OLDEST = datetime.min.replace(tzinfo=timezone.utc)
+
+
+async def _get_listing(db: AsyncSession, allegro_account: AllegroAccount, kind: str,
+                       limit: int, offset: int, fresh: bool) -> dict:
+    """
+    Отдает страницу списка из локальной копии, если она свежая. Иначе идет в Allegro
+    и обновляет строки копии; полным список отмечает только проход воркера.
+    """
+    mirror = ConversationMirrorService(db)
+    if not fresh:
+        data = await mirror.get_listing(allegro_account.id, kind, limit=limit, offset=offset)
+        if data is not None:
+            return data
+
+    client = AllegroClient(db=db, allegro_account=allegro_account)
+    if kind == THREAD:
+        data = await client.get_threads(limit=limit, offset=offset)
+    else:
+        data = await client.get_issues(limit=limit, offset=offset)
+
+    try:
+        await mirror.upsert_conversations(allegro_account.id, kind, data.get(f"{kind}s", []))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.warning("Не удалось обновить локальную копию диалогов", kind=kind, details=str(e))
+    return {**data, "source": "live", "syncedAt": datetime.now(timezone.utc).isoformat()}
+
+
+async def _get_messages(db: AsyncSession, allegro_account: AllegroAccount, kind: str,
+                        conversation_id: str, fresh: bool) -> dict:
+    mirror = ConversationMirrorService(db)
+    if not fresh:
+        # Обсуждения Allegro отдает целиком, диалоги - последней страницей
+        limit = MESSAGES_PAGE_LIMIT if kind == THREAD else None
+        data = await mirror.get_messages(allegro_account.id, kind, conversation_id, limit=limit)
+        if data is not None:
+            return data
+
+    client = AllegroClient(db=db, allegro_account=allegro_account)
+    if kind == THREAD:
+        data = await client.get_thread_messages(thread_id=conversation_id, limit=MESSAGES_PAGE_LIMIT)
+    else:
+        data = await client.get_issue_messages(issue_id=conversation_id)
+
+    try:
+        await mirror.upsert_messages(allegro_account.id, kind, conversation_id, data.get("messages", []))
+        await mirror.mark_messages_synced(allegro_account.id, kind, conversation_id)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.warning("Не удалось обновить локальную копию сообщений", kind=kind, details=str(e))
+    return {**data, "source": "live", "syncedAt": datetime.now(timezone.utc).isoformat()}
+
+
+async def _record_sent_message(db: AsyncSession, allegro_account: AllegroAccount, kind: str,
+                               conversation_id: str, raw_message: dict):
+    try:
+        await ConversationMirrorService(db).record_sent_message(allegro_account.id, kind, conversation_id, raw_message)
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.warning("Не удалось записать отправленное сообщение в локальную копию", kind=kind, details=str(e))
+
 
 @router.get("/{allegro_account_id}/threads", response_model=APIResponse[dict], summary="Получить только диалоги (threads)")
 @limiter.limit("100/minute")
@@ -27,11 +99,11 @@ async def get_allegro_threads(
     allegro_account: AllegroAccount = Depends(get_authorized_allegro_account),
     db: AsyncSession = Depends(get_db),
     limit: int = Query(20, ge=1, le=100),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    fresh: bool = Query(False, description="Игнорировать локальную копию и запросить Allegro")
 ):
     """Возвращает список только обычных диалогов (threads)."""
-    client = AllegroClient(db=db, allegro_account=allegro_account)
-    data = await client.get_threads(limit=limit, offset=offset)
+    data = await _get_listing(db, allegro_account, THREAD, limit=limit, offset=offset, fresh=fresh)
     return APIResponse(data=data)
 
 
@@ -42,61 +114,125 @@ async def get_allegro_issues(
     allegro_account: AllegroAccount = Depends(get_authorized_allegro_account),
     db: AsyncSession = Depends(get_db),
     limit: int = Query(20, ge=1, le=100),
-    offset: int = Query(0, ge=0)
+    offset: int = Query(0, ge=0),
+    fresh: bool = Query(False, description="Игнорировать локальную копию и запросить Allegro")
 ):
     """Возвращает список только обсуждений и претензий (issues)."""
-    client = AllegroClient(db=db, allegro_account=allegro_account)
-    data = await client.get_issues(limit=limit, offset=offset)
+    data = await _get_listing(db, allegro_account, ISSUE, limit=limit, offset=offset, fresh=fresh)
     return APIResponse(data=data)
 
 
+def _encode_cursor(offsets: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(offsets, separators=(",", ":")).encode()).decode()
+
+
+def _decode_cursor(cursor: Optional[str]) -> dict:
+    """Курсор объединенного списка - смещения в каждом источнике: {"thread": n, "issue": m}."""
+    if not cursor:
+        return {THREAD: 0, ISSUE: 0}
+    try:
+        offsets = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {kind: max(0, int(offsets.get(kind, 0))) for kind in (THREAD, ISSUE)}
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
+
+def _to_conversation(kind: str, item: dict) -> dict:
+    if kind == THREAD:
+        return {
+            "id": item.get('id'),
+            "type": "message",
+            "lastMessageDateTime": item.get('lastMessageDateTime'),
+            "read": item.get('read'),
+            "interlocutor": item.get('interlocutor')
+        }
+    return {
+        "id": item.get('id'),
+        "type": item.get('type', 'issue').lower(),
+        "lastMessageDateTime": item.get('lastUpdateDateTime'),
+        "read": item.get('read'),
+        "subject": item.get('subject')
+    }
+
+
+async def _fetch_source(allegro_account: AllegroAccount, kind: str, limit: int, offset: int, fresh: bool) -> dict:
+    # У каждого источника своя сессия: одну AsyncSession нельзя использовать из параллельных корутин
+    async with AsyncSessionLocal() as source_db:
+        return await _get_listing(source_db, allegro_account, kind, limit=limit, offset=offset, fresh=fresh)
+
+
 @router.get("/{allegro_account_id}/conversations", response_model=APIResponse[dict], summary="Получить все диалоги и обсуждения вместе")
 @limiter.limit("100/minute")
 async def get_all_conversations(
         request: Request,
         allegro_account: AllegroAccount = Depends(get_authorized_allegro_account),
         limit: int = Query(20, ge=1, le=100),
-        offset: int = Query(0, ge=0),
-        db: AsyncSession = Depends(get_db)
+        cursor: Optional[str] = Query(None, description="nextCursor из предыдущей страницы"),
+        fresh: bool = Query(False, description="Игнорировать локальную копию и запросить Allegro"),
 ):
-    client = AllegroClient(db=db, allegro_account=allegro_account)
-    all_conversations = []
+    """
+    Диалоги и обсуждения одним списком от новых к старым. Оба источника запрашиваются
+    параллельно, не больше limit элементов из каждого, и сливаются k-way merge.
+    Позиция в каждом источнике хранится в непрозрачном курсоре, поэтому глубокие
+    страницы остаются корректными.
+    """
+    offsets = _decode_cursor(cursor)
     errors = []
+    sources = {}
+    error_messages = {
+        THREAD: "Could not fetch regular messages.",
+        ISSUE: "Could not fetch discussions and claims (Allegro internal error).",
+    }
 
-    try:
-        threads_response = await client.get_threads(limit=limit, offset=offset)
-        for thread in threads_response.get('threads', []):
-            all_conversations.append({
-                "id": thread.get('id'),
-                "type": "message",
-                "lastMessageDateTime": thread.get('lastMessageDateTime'),
-                "read": thread.get('read'),
-                "interlocutor": thread.get('interlocutor')
-            })
-    except Exception as e:
-        logger.error("Ошибка получения threads", details=str(e))
-        errors.append("Could not fetch regular messages.")
+    responses = await asyncio.gather(
+        *(_fetch_source(allegro_account, kind, limit, offsets[kind], fresh) for kind in (THREAD, ISSUE)),
+        return_exceptions=True
+    )
 
-    try:
-        issues_response = await client.get_issues(limit=limit, offset=offset)
-        for issue in issues_response.get('issues', []):
-            all_conversations.append({
-                "id": issue.get('id'),
-                "type": issue.get('type', 'issue').lower(),
-                "lastMessageDateTime": issue.get('lastUpdateDateTime'),
-                "read": issue.get('read'),
-                "subject": issue.get('subject')
-            })
-    except Exception as e:
-        logger.error("Ошибка получения issues", details=str(e))
-        errors.append("Could not fetch discussions and claims (Allegro internal error).")
+    feeds = []
+    fetched = {THREAD: 0, ISSUE: 0}
+    exhausted = {THREAD: False, ISSUE: False}
+    failed = set()
+    for kind, response in zip((THREAD, ISSUE), responses):
+        if isinstance(response, Exception):
+            logger.error(f"Ошибка получения {kind}s", details=str(response))
+            errors.append(error_messages[kind])
+            failed.add(kind)
+            continue
+        sources[f"{kind}s"] = {"source": response["source"], "syncedAt": response["syncedAt"]}
+        items = response.get(f"{kind}s", [])
+        fetched[kind] = len(items)
+        exhausted[kind] = len(items) < limit
+        # Время разбираем один раз на элемент; ключ сортировки - (время, источник, позиция)
+        feed = []
+        for position, item in enumerate(items):
+            conversation = _to_conversation(kind, item)
+            last_at = parse_allegro_datetime(conversation["lastMessageDateTime"]) or _OLDEST
+            feed.append((last_at, kind, -position, conversation))
+        feed.sort(key=lambda entry: entry[:3], reverse=True)
+        feeds.append(feed)
 
-    all_conversations.sort(
-        key=lambda x: datetime.fromisoformat(x['lastMessageDateTime'].replace('Z', '+00:00')),
-        reverse=True
-    )
+    conversations = []
+    consumed = {THREAD: 0, ISSUE: 0}
+    merged = heapq.merge(*feeds, key=lambda entry: entry[:3], reverse=True)
+    for _, kind, _, conversation in itertools.islice(merged, limit):
+        conversations.append(conversation)
+        consumed[kind] += 1
 
-    data = {"conversations": all_conversations, "errors": errors}
+    next_offsets = {kind: offsets[kind] + consumed[kind] for kind in (THREAD, ISSUE)}
+    # Источник, упавший на этой странице, перезапрашивается следующей страницей, но только если
+    # она что-то продвинула: пустая страница, за которой остались лишь упавшие источники,
+    # возвращается без курсора, иначе клиент бесконечно листал бы пустые страницы.
+    # Повторить ее можно с тем же курсором.
+    has_more = any(not exhausted[kind] or consumed[kind] < fetched[kind]
+                   for kind in (THREAD, ISSUE) if kind not in failed)
+    has_more = has_more or bool(failed and conversations)
+    data = {
+        "conversations": conversations,
+        "errors": errors,
+        "sources": sources,
+        "nextCursor": _encode_cursor(next_offsets) if has_more else None,
+    }
     return APIResponse(data=data)
 
 
@@ -106,10 +242,10 @@ async def get_allegro_thread_messages(
     request: Request,
     thread_id: str,
     allegro_account: AllegroAccount = Depends(get_authorized_allegro_account),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    fresh: bool = Query(False, description="Игнорировать локальную копию и запросить Allegro")
 ):
-    client = AllegroClient(db=db, allegro_account=allegro_account)
-    data = await client.get_thread_messages(thread_id=thread_id)
+    data = await _get_messages(db, allegro_account, THREAD, thread_id, fresh=fresh)
     return APIResponse(data=data)
 
 @router.post("/{allegro_account_id}/threads/{thread_id}/messages", response_model=APIResponse[dict], status_code=status.HTTP_201_CREATED, summary="Отправить сообщение в диалог")
@@ -123,6 +259,7 @@ async def post_allegro_thread_message(
 ):
     client = AllegroClient(db=db, allegro_account=allegro_account)
     data = await client.post_thread_message(thread_id=thread_id, text=message.text, attachment_id=message.attachment_id)
+    await _record_sent_message(db, allegro_account, THREAD, thread_id, data)
     return APIResponse(data=data)
 
 
@@ -132,10 +269,10 @@ async def get_allegro_issue_messages(
     request: Request,
     issue_id: str,
     allegro_account: AllegroAccount = Depends(get_authorized_allegro_account),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    fresh: bool = Query(False, description="Игнорировать локальную копию и запросить Allegro")
 ):
-    client = AllegroClient(db=db, allegro_account=allegro_account)
-    data = await client.get_issue_messages(issue_id=issue_id)
+    data = await _get_messages(db, allegro_account, ISSUE, issue_id, fresh=fresh)
     return APIResponse(data=data)
 
 @router.post("/{allegro_account_id}/issues/{issue_id}/messages", response_model=APIResponse[dict], status_code=status.HTTP_201_CREATED, summary="Отправить сообщение в обсуждение")
@@ -149,6 +286,7 @@ async def post_allegro_issue_message(
 ):
     client = AllegroClient(db=db, allegro_account=allegro_account)
     data = await client.post_issue_message(issue_id=issue_id, text=message.text)
+    await _record_sent_message(db, allegro_account, ISSUE, issue_id, data)
     return APIResponse(data=data)
 
 
@@ -0,0 +1,64 @@
+# routers/search.py
+from fastapi import APIRouter, Depends, Query, Request
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.database import get_db
+from models.models import AllegroAccount
+from schemas.api import APIResponse
+from schemas.message import MessageSearchHit, MessageSearchResults
+from utils.dependencies import get_authorized_allegro_account
+from utils.rate_limiter import limiter
+
+router = APIRouter(prefix="/api/allegro", tags=["Allegro Search"])
+
+# Ранжируем и режем страницу по индексу, а ts_headline считаем только для попавших в нее строк
+SEARCH_QUERY = text("""
+    WITH query AS (
+        SELECT websearch_to_tsquery('simple', :q) AS tsq
+    ), page AS (
+        SELECT m.id, m.conversation_kind, m.conversation_id, m.created_at, m.author_login, m.text,
+               ts_rank(m.search_vector, query.tsq) AS rank
+        FROM allegro_messages AS m, query
+        WHERE m.allegro_account_id = :account_id AND m.search_vector @@ query.tsq
+        ORDER BY rank DESC, m.created_at DESC
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT page.id, page.conversation_kind, page.conversation_id, page.created_at, page.author_login, page.rank,
+           ts_headline('simple', coalesce(page.text, ''), query.tsq,
+                       'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5') AS snippet
+    FROM page, query
+    ORDER BY page.rank DESC, page.created_at DESC;
+""")
+
+
+@router.get("/{allegro_account_id}/search", response_model=APIResponse[MessageSearchResults],
+            summary="Поиск по сообщениям аккаунта")
+@limiter.limit("60/minute")
+async def search_messages(
+    request: Request,
+    q: str = Query(..., min_length=2, max_length=200, description="Логин покупателя, номер заказа или фраза"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    allegro_account: AllegroAccount = Depends(get_authorized_allegro_account),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Ищет по локальной копии сообщений аккаунта (полнотекстовый индекс Postgres).
+    Результаты отсортированы по релевантности, совпадения в сниппетах выделены <mark>.
+    """
+    rows = (await db.execute(SEARCH_QUERY, {
+        "q": q, "account_id": allegro_account.id, "limit": limit, "offset": offset,
+    })).all()
+    hits = [
+        MessageSearchHit(
+            message_id=row.id,
+            conversation_kind=row.conversation_kind,
+            conversation_id=row.conversation_id,
+            created_at=row.created_at,
+            author_login=row.author_login,
+            rank=row.rank,
+            snippet=row.snippet,
+        )
+        for row in rows
+    ]
+    return APIResponse(data=MessageSearchResults(query=q, hits=hits, limit=limit, offset=offset))
@@ -1,6 +1,22 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
+from datetime import datetime
 
 class MessageCreate(BaseModel):
     text: str
-    attachment_id: Optional[str] = None
\ No newline at end of file
+    attachment_id: Optional[str] = None
+
+class MessageSearchHit(BaseModel):
+    message_id: str
+    conversation_kind: str
+    conversation_id: str
+    created_at: Optional[datetime] = None
+    author_login: Optional[str] = None
+    rank: float
+    snippet: str
+
+class MessageSearchResults(BaseModel):
+    query: str
+    hits: List[MessageSearchHit]
+    limit: int
+    offset: int
@@ -1,41 +1,207 @@
 # services/allegro_client.py
+import asyncio
 import httpx
+import weakref
 from datetime import datetime, timezone, timedelta
 from fastapi import HTTPException, status
+from sqlalchemy import select, update, text
 from sqlalchemy.ext.asyncio import AsyncSession
-from contextlib import asynccontextmanager
-from utils.security import decrypt_data, encrypt_data
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from utils.security import encrypt_data, token_cache
+from utils.logger import logger
 from models.models import AllegroAccount
+from models.database import AsyncSessionLocal
 from config import settings
 from .allegro_service import AllegroService
+from .http_client import get_http_client
+from .allegro_rate_limiter import allegro_rate_limiter, parse_retry_after
+from .allegro_resilience import IDEMPOTENT_METHODS, CircuitOpenError, backoff_delay, circuit_breakers
 
-ALLEGRO_API_URL = "https://api.allegro.pl"
+# Максимальные размеры страниц, которые принимает Allegro
+THREADS_PAGE_LIMIT = 20
+ISSUES_PAGE_LIMIT = 100
+MESSAGES_PAGE_LIMIT = 20
+
+# Пространство ключей pg_advisory_xact_lock для обновления токенов (второй ключ - id аккаунта)
+TOKEN_REFRESH_LOCK_NAMESPACE = 7301
+
+_refresh_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _get_refresh_lock(account_id: int) -> asyncio.Lock:
+    lock = _refresh_locks.get(account_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _refresh_locks[account_id] = lock
+    return lock
+
+
+def parse_allegro_datetime(value: Optional[str]) -> Optional[datetime]:
+    """Разбирает дату из ответа Allegro (ISO 8601 с 'Z')."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+async def refresh_account_tokens(account_id: int, stale_access_token: str) -> Optional[dict]:
+    """
+    Обновляет токены аккаунта в режиме single-flight: внутри процесса вызовы для одного
+    аккаунта ждут на asyncio.Lock, между процессами (web, воркеры, фоновое обновление) -
+    на pg_advisory_xact_lock. Если пока мы ждали, токены уже обновил кто-то другой
+    (access-токен в БД отличается от stale_access_token), берем их из БД и не тратим
+    refresh-токен повторно: Allegro ротирует его при каждом обновлении.
+    Возвращает зашифрованные токены, expires_at и refreshed (ходили ли в Allegro), или None.
+    """
+    async with _get_refresh_lock(account_id):
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                await db.execute(
+                    text("SELECT pg_advisory_xact_lock(:namespace, :account_id)"),
+                    {"namespace": TOKEN_REFRESH_LOCK_NAMESPACE, "account_id": account_id}
+                )
+                current = (await db.execute(
+                    select(AllegroAccount.access_token, AllegroAccount.refresh_token, AllegroAccount.expires_at)
+                    .where(AllegroAccount.id == account_id)
+                )).one_or_none()
+                if current is None:
+                    return None
+
+                if current.access_token != stale_access_token:
+                    logger.info("Токен Allegro уже обновлен другим запросом, используем его.",
+                                account_id=account_id)
+                    token_cache.invalidate(account_id)
+                    return {
+                        "access_token": current.access_token,
+                        "refresh_token": current.refresh_token,
+                        "expires_at": current.expires_at,
+                        "refreshed": False,
+                    }
+
+                service = AllegroService(
+                    client_id=settings.ALLEGRO_CLIENT_ID,
+                    client_secret=settings.ALLEGRO_CLIENT_SECRET,
+                    redirect_uri=settings.ALLEGRO_REDIRECT_URI,
+                    auth_url=settings.ALLEGRO_AUTH_URL
+                )
+                decrypted_refresh_token = token_cache.decrypt(account_id, current.refresh_token, kind="refresh")
+                new_token_data = await service.refresh_tokens(decrypted_refresh_token)
+
+                if not new_token_data or 'access_token' not in new_token_data:
+                    logger.critical(
+                        "Не удалось обновить токен Allegro, отсутствует access_token.",
+                        account_id=account_id
+                    )
+                    return None
+
+                access_token = encrypt_data(new_token_data['access_token'])
+                refresh_token = encrypt_data(new_token_data['refresh_token'])
+                expires_in = new_token_data.get('expires_in', 3600)
+                expires_at = datetime.now(timezone.utc) + timedelta(seconds=int(expires_in))
+                await db.execute(
+                    update(AllegroAccount)
+                    .where(AllegroAccount.id == account_id)
+                    .values(access_token=access_token, refresh_token=refresh_token, expires_at=expires_at)
+                )
+
+    # Старые токены больше недействительны: не держим их расшифрованными до истечения TTL
+    token_cache.invalidate(account_id)
+    return {"access_token": access_token, "refresh_token": refresh_token, "expires_at": expires_at, "refreshed": True}
 
 
 class AllegroClient:
-    def __init__(self, db: AsyncSession, allegro_account: AllegroAccount):
+    def __init__(self, db: Optional[AsyncSession], allegro_account: AllegroAccount):
+        """
+        db - сессия запроса (может быть None в фоновой обработке). Обновленные токены
+        всегда сохраняются собственной короткой транзакцией под advisory-блокировкой,
+        чтобы ротация refresh-токена не терялась при откате сессии запроса.
+        """
         self.db = db
         self.allegro_account = allegro_account
 
-    @asynccontextmanager
-    async def _get_http_client(self) -> httpx.AsyncClient:
-
-        access_token = decrypt_data(self.allegro_account.access_token)
+    def _get_headers(self, extra_headers: Optional[dict] = None) -> dict:
+        """Заголовки конкретного аккаунта; передаются в каждом запросе через общий пул соединений."""
+        access_token = token_cache.decrypt(self.allegro_account.id, self.allegro_account.access_token)
         headers = {
             "Authorization": f"Bearer {access_token}",
             "Accept": "application/vnd.allegro.public.v1+json",
             "Content-Type": "application/vnd.allegro.public.v1+json"
         }
-        async with httpx.AsyncClient(base_url=ALLEGRO_API_URL, headers=headers) as client:
-            yield client
+        if extra_headers:
+            headers.update(extra_headers)
+        return headers
+
+    def _token_expires_soon(self) -> bool:
+        expires_at = self.allegro_account.expires_at
+        margin = timedelta(seconds=settings.ALLEGRO_TOKEN_REFRESH_MARGIN_SECONDS)
+        return expires_at is not None and expires_at - margin <= datetime.now(timezone.utc)
+
+    async def _send(self, method: str, url: str, headers: dict, **kwargs) -> httpx.Response:
+        """
+        Отправляет запрос через лимитер и автомат эндпоинта.
+        - 429: аккаунт приостанавливается на Retry-After, и запрос встает в очередь повторно.
+        - 5xx и сетевые ошибки: идемпотентные запросы повторяются с экспоненциальной
+          задержкой и джиттером; каждый сбой учитывается автоматом эндпоинта.
+        """
+        client = get_http_client()
+        account_id = self.allegro_account.id
+        breaker = circuit_breakers.get(method, url)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        rate_limit_retries = 0
+        transient_retries = 0
+
+        while True:
+            breaker.before_request()
+            await allegro_rate_limiter.acquire(account_id)
+            try:
+                response = await client.request(method, f"{settings.ALLEGRO_API_URL}{url}", headers=headers,
+                                                **kwargs)
+            except httpx.RequestError as e:
+                breaker.record_failure()
+                if not idempotent or transient_retries >= settings.ALLEGRO_RETRY_MAX_ATTEMPTS:
+                    raise
+                transient_retries += 1
+                breaker.retries += 1
+                logger.warning("Сетевая ошибка Allegro, повторяем запрос", url=url, error=str(e),
+                               attempt=transient_retries)
+                await asyncio.sleep(backoff_delay(transient_retries))
+                continue
+
+            if response.status_code >= 500:
+                breaker.record_failure()
+                if not idempotent or transient_retries >= settings.ALLEGRO_RETRY_MAX_ATTEMPTS:
+                    return response
+                transient_retries += 1
+                breaker.retries += 1
+                logger.warning("Allegro вернул ошибку сервера, повторяем запрос", url=url,
+                               status_code=response.status_code, attempt=transient_retries)
+                await asyncio.sleep(backoff_delay(transient_retries))
+                continue
+
+            breaker.record_success()
+            if (response.status_code != status.HTTP_429_TOO_MANY_REQUESTS
+                    or rate_limit_retries >= settings.ALLEGRO_RATE_LIMIT_MAX_RETRIES):
+                return response
+            retry_after = parse_retry_after(response.headers)
+            if retry_after is None:
+                retry_after = settings.ALLEGRO_RETRY_AFTER_DEFAULT_SECONDS * 2 ** rate_limit_retries
+            rate_limit_retries += 1
+            logger.warning("Allegro вернул 429, откладываем запрос", account_id=account_id,
+                           url=url, retry_after=retry_after, attempt=rate_limit_retries)
+            await allegro_rate_limiter.block(account_id, retry_after)
 
     async def _request(self, method: str, url: str, is_retry: bool = False, **kwargs):
+        if not is_retry and self._token_expires_soon():
+            # Обновляем заранее, не дожидаясь лишнего круга с 401
+            await self._refresh_and_save_tokens()
+
+        request_kwargs = dict(kwargs)
+        headers = self._get_headers(request_kwargs.pop("headers", None))
 
         try:
-            async with self._get_http_client() as client:
-                response = await client.request(method, url, **kwargs)
-                response.raise_for_status()
-                return response.json() if response.content else {}
+            response = await self._send(method, url, headers, **request_kwargs)
+            response.raise_for_status()
+            return response.json() if response.content else {}
         except httpx.HTTPStatusError as e:
             if e.response.status_code == status.HTTP_401_UNAUTHORIZED and not is_retry:
                 logger.info(
@@ -56,6 +222,12 @@ class AllegroClient:
                 status_code=e.response.status_code,
                 detail=f"Error from Allegro API: {error_details}"
             )
+        except CircuitOpenError as e:
+            logger.warning("Запрос к Allegro отклонен автоматом", endpoint=e.endpoint, retry_in=e.retry_in)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Allegro API is temporarily unavailable."
+            )
         except httpx.RequestError as e:
             logger.error(
                 "Сетевая ошибка при запросе к Allegro API",
@@ -68,40 +240,89 @@ class AllegroClient:
             )
 
     async def _refresh_and_save_tokens(self) -> bool:
-        service = AllegroService(
-            client_id=settings.ALLEGRO_CLIENT_ID,
-            client_secret=settings.ALLEGRO_CLIENT_SECRET,
-            redirect_uri=settings.ALLEGRO_REDIRECT_URI,
-            auth_url=settings.ALLEGRO_AUTH_URL
-        )
-        decrypted_refresh_token = decrypt_data(self.allegro_account.refresh_token)
-        new_token_data = await service.refresh_tokens(decrypted_refresh_token)
-
-        if not new_token_data or 'access_token' not in new_token_data:
-            logger.critical(
-                "Не удалось обновить токен Allegro, отсутствует access_token.",
-                account_id=self.allegro_account.id
-            )
+        """Обновляет токены аккаунта через общий single-flight путь (refresh_account_tokens)."""
+        tokens = await refresh_account_tokens(self.allegro_account.id, self.allegro_account.access_token)
+        if tokens is None:
             return False
-
-        self.allegro_account.access_token = encrypt_data(new_token_data['access_token'])
-        self.allegro_account.refresh_token = encrypt_data(new_token_data['refresh_token'])
-        expires_in = new_token_data.get('expires_in', 3600)
-        self.allegro_account.expires_at = datetime.now(timezone.utc) + timedelta(seconds=int(expires_in))
-
-        self.db.add(self.allegro_account)
-        await self.db.flush()
-
-        logger.info(
-            "Токен Allegro успешно обновлен в сессии.",
-            account_login=self.allegro_account.allegro_login
-        )
+        self._apply_tokens(tokens["access_token"], tokens["refresh_token"], tokens["expires_at"])
+        if tokens["refreshed"]:
+            logger.info(
+                "Токен Allegro успешно обновлен.",
+                account_login=self.allegro_account.allegro_login
+            )
         return True
 
+    def _apply_tokens(self, access_token: str, refresh_token: str, expires_at: datetime):
+        """
+        Обновляет токены только в памяти. Атрибуты выставляются как уже сохраненные, иначе
+        аккаунт в сессии вызывающего кода стал бы грязным, и любой ее commit записал бы
+        эти токены поверх более новых. В БД токены пишет только refresh_account_tokens.
+        """
+        set_committed_value(self.allegro_account, "access_token", access_token)
+        set_committed_value(self.allegro_account, "refresh_token", refresh_token)
+        set_committed_value(self.allegro_account, "expires_at", expires_at)
+
     async def get_threads(self, limit: int = 20, offset: int = 0):
         """Получает список диалогов (threads)."""
         return await self._request("GET", f"/messaging/threads?limit={limit}&offset={offset}")
 
+    async def _iter_pages(
+            self,
+            fetch_page: Callable[..., Awaitable[dict]],
+            items_key: str,
+            page_size: int,
+            stop: Optional[Callable[[dict], bool]] = None,
+            max_pages: Optional[int] = None,
+            on_truncated: Optional[Callable[[], None]] = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Постранично отдает элементы списка Allegro. Следующая страница запрашивается,
+        пока обрабатывается текущая. Итерация прекращается на первом элементе,
+        для которого stop(item) истинно, или после max_pages страниц; во втором случае,
+        если за последней страницей могли быть еще элементы, вызывается on_truncated().
+        """
+        offset = 0
+        pages = 0
+        next_page = asyncio.create_task(fetch_page(limit=page_size, offset=offset))
+        try:
+            truncated = False
+            while next_page is not None:
+                page = await next_page
+                next_page = None
+                pages += 1
+                items = page.get(items_key, [])
+                if len(items) == page_size:
+                    if max_pages is None or pages < max_pages:
+                        offset += page_size
+                        next_page = asyncio.create_task(fetch_page(limit=page_size, offset=offset))
+                    else:
+                        truncated = True
+                for item in items:
+                    if stop is not None and stop(item):
+                        return
+                    yield item
+            if truncated and on_truncated is not None:
+                on_truncated()
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+                try:
+                    await next_page
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+    def iter_threads(self, stop: Optional[Callable[[dict], bool]] = None, max_pages: Optional[int] = None,
+                     page_size: int = THREADS_PAGE_LIMIT,
+                     on_truncated: Optional[Callable[[], None]] = None) -> AsyncIterator[dict]:
+        """Перебирает все диалоги (от новых к старым) с предзагрузкой следующей страницы."""
+        return self._iter_pages(self.get_threads, "threads", page_size, stop, max_pages, on_truncated)
+
+    def iter_issues(self, stop: Optional[Callable[[dict], bool]] = None, max_pages: Optional[int] = None,
+                    page_size: int = ISSUES_PAGE_LIMIT,
+                    on_truncated: Optional[Callable[[], None]] = None) -> AsyncIterator[dict]:
+        """Перебирает все обсуждения и претензии с предзагрузкой следующей страницы."""
+        return self._iter_pages(self.get_issues, "issues", page_size, stop, max_pages, on_truncated)
+
     async def get_thread_messages(self, thread_id: str, limit: int = 20, offset: int = 0):
         """Получает сообщения из конкретного диалога."""
         return await self._request("GET", f"/messaging/threads/{thread_id}/messages?limit={limit}&offset={offset}")
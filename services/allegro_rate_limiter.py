@@ -0,0 +1,149 @@
+# services/allegro_rate_limiter.py
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from cachetools import TTLCache
+from config import settings
+from utils.logger import logger
+
+GLOBAL_SCOPE = "global"
+
+# Token bucket с резервированием: токены могут уйти в минус, тогда запрос ждет,
+# пока бакет не восполнит долг. KEYS: бакет и ключ блокировки (Retry-After) для каждой области.
+_REDIS_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local wait = 0
+for i = 1, #KEYS, 2 do
+    local rate = tonumber(ARGV[i])
+    local capacity = tonumber(ARGV[i + 1])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) * rate / 1000) - 1
+    redis.call('HSET', KEYS[i], 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil(capacity * 1000 / rate) + 60000)
+    if tokens < 0 then
+        wait = math.max(wait, math.ceil(-tokens * 1000 / rate))
+    end
+    wait = math.max(wait, redis.call('PTTL', KEYS[i + 1]))
+end
+return wait
+"""
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Возвращает задержку в секундах из Retry-After (число секунд или HTTP-дата)."""
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Резервирует токен и возвращает, сколько секунд нужно подождать до его использования."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate) - 1
+        self.updated_at = now
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class AllegroRateLimiter:
+    """
+    Клиентский ограничитель запросов к Allegro: общий бакет на приложение и бакет на аккаунт.
+    Запросы не отклоняются, а ждут своей очереди. Retry-After из ответов 429 блокирует
+    область аккаунта на указанное время. При заданном ALLEGRO_RATE_LIMIT_REDIS_URL
+    состояние бакетов общее для всех процессов.
+    """
+
+    def __init__(self, redis_url: Optional[str] = None):
+        self._global = TokenBucket(settings.ALLEGRO_RATE_LIMIT_PER_SECOND, settings.ALLEGRO_RATE_LIMIT_BURST)
+        self._accounts = TTLCache(maxsize=100_000, ttl=3600)
+        self._redis = None
+        self._redis_script = None
+        if redis_url:
+            import redis.asyncio as aioredis
+            self._redis = aioredis.from_url(redis_url)
+            self._redis_script = self._redis.register_script(_REDIS_ACQUIRE_SCRIPT)
+        self.throttled = 0
+        self.total_wait_seconds = 0.0
+        self.rate_limited_responses = 0
+
+    def _account_bucket(self, account_id: int) -> TokenBucket:
+        bucket = self._accounts.get(account_id)
+        if bucket is None:
+            bucket = TokenBucket(settings.ALLEGRO_ACCOUNT_RATE_LIMIT_PER_SECOND,
+                                 settings.ALLEGRO_ACCOUNT_RATE_LIMIT_BURST)
+            self._accounts[account_id] = bucket
+        return bucket
+
+    @staticmethod
+    def _redis_keys(scope: str) -> list:
+        return [f"allegro:ratelimit:{scope}:bucket", f"allegro:ratelimit:{scope}:blocked"]
+
+    async def _reserve(self, account_id: int) -> float:
+        if self._redis is not None:
+            try:
+                wait_ms = await self._redis_script(
+                    keys=self._redis_keys(GLOBAL_SCOPE) + self._redis_keys(str(account_id)),
+                    args=[
+                        settings.ALLEGRO_RATE_LIMIT_PER_SECOND, settings.ALLEGRO_RATE_LIMIT_BURST,
+                        settings.ALLEGRO_ACCOUNT_RATE_LIMIT_PER_SECOND, settings.ALLEGRO_ACCOUNT_RATE_LIMIT_BURST,
+                    ],
+                )
+                return int(wait_ms) / 1000
+            except Exception as e:
+                logger.warning("Redis недоступен для лимитера Allegro, используем локальные бакеты",
+                               details=str(e))
+        return max(self._global.reserve(), self._account_bucket(account_id).reserve())
+
+    async def acquire(self, account_id: int):
+        """Ждет, пока запрос аккаунта можно отправить, не превышая лимиты."""
+        wait = await self._reserve(account_id)
+        if wait > 0:
+            self.throttled += 1
+            self.total_wait_seconds += wait
+            await asyncio.sleep(wait)
+
+    async def block(self, account_id: int, seconds: float):
+        """Приостанавливает запросы аккаунта (после 429 с Retry-After)."""
+        self.rate_limited_responses += 1
+        self._account_bucket(account_id).block(seconds)
+        if self._redis is not None:
+            try:
+                await self._redis.set(self._redis_keys(str(account_id))[1], 1, px=max(1, int(seconds * 1000)))
+            except Exception as e:
+                logger.warning("Не удалось записать блокировку лимитера в Redis", details=str(e))
+
+    def stats(self) -> dict:
+        return {
+            "mode": "redis" if self._redis is not None else "local",
+            "throttled": self.throttled,
+            "total_wait_seconds": round(self.total_wait_seconds, 3),
+            "rate_limited_responses": self.rate_limited_responses,
+        }
+
+
+allegro_rate_limiter = AllegroRateLimiter(redis_url=settings.ALLEGRO_RATE_LIMIT_REDIS_URL)
@@ -0,0 +1,110 @@
+# services/allegro_resilience.py
+import random
+import re
+import time
+from typing import Dict
+from config import settings
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+_STATIC_SEGMENT = re.compile(r"^[a-z-]+$")
+
+
+class CircuitOpenError(Exception):
+    """Эндпоинт Allegro временно отключен автоматом после серии сбоев."""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+        super().__init__(f"Circuit for {endpoint} is open, retry in {retry_in:.1f}s")
+
+
+def endpoint_key(method: str, url: str) -> str:
+    """Шаблон эндпоинта без query и идентификаторов: GET /messaging/threads/{id}/messages."""
+    path = url.split("?", 1)[0]
+    segments = [segment if _STATIC_SEGMENT.match(segment) else "{id}" for segment in path.strip("/").split("/")]
+    return f"{method.upper()} /{'/'.join(segments)}"
+
+
+def backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с полным джиттером для попытки attempt (с 1)."""
+    cap = min(settings.ALLEGRO_RETRY_MAX_DELAY_SECONDS, settings.ALLEGRO_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, endpoint: str, failure_threshold: int, reset_timeout: float):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = 0.0
+        self.short_circuited = 0
+        self.retries = 0
+        self.failures = 0
+
+    def before_request(self):
+        """Пропускает запрос или бросает CircuitOpenError. В half-open пропускает одну пробную попытку."""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            retry_in = self.opened_at + self.reset_timeout - now
+            if retry_in > 0:
+                self.short_circuited += 1
+                raise CircuitOpenError(self.endpoint, retry_in)
+            self.state = self.HALF_OPEN
+            self.trial_started_at = now
+            return
+        if self.state == self.HALF_OPEN:
+            # Пробный запрос уже идет; если он завис дольше reset_timeout, пускаем следующий
+            if now - self.trial_started_at < self.reset_timeout:
+                self.short_circuited += 1
+                raise CircuitOpenError(self.endpoint, self.trial_started_at + self.reset_timeout - now)
+            self.trial_started_at = now
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failures": self.failures,
+            "retries": self.retries,
+            "short_circuited": self.short_circuited,
+        }
+
+
+class CircuitBreakerRegistry:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, method: str, url: str) -> CircuitBreaker:
+        key = endpoint_key(method, url)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                key,
+                failure_threshold=settings.ALLEGRO_BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=settings.ALLEGRO_BREAKER_RESET_SECONDS,
+            )
+            self._breakers[key] = breaker
+        return breaker
+
+    def stats(self) -> dict:
+        return {key: breaker.stats() for key, breaker in self._breakers.items()}
+
+
+circuit_breakers = CircuitBreakerRegistry()
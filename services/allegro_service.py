@@ -7,6 +7,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from models.models import User, AllegroAccount
 from utils.security import encrypt_data
+from utils.logger import logger
+from services.task_queue_service import TaskQueueService
+from services.http_client import get_http_client
 from config import settings
 
 
@@ -29,16 +32,16 @@ class AllegroService:
             "code": code,
             "redirect_uri": self.redirect_uri,
         }
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(f"{self.auth_url}/token", auth=auth_header, data=data)
-                response.raise_for_status()
-                token_data = response.json()
-                if 'access_token' not in token_data:
-                    raise HTTPException(status_code=400, detail="Allegro nie zwróciło 'access_token'.")
-                return token_data
-            except httpx.HTTPStatusError as e:
-                raise HTTPException(status_code=400, detail=f"HTTP Ошибка от Allegro: {e.response.text}")
+        client = get_http_client()
+        try:
+            response = await client.post(f"{self.auth_url}/token", auth=auth_header, data=data)
+            response.raise_for_status()
+            token_data = response.json()
+            if 'access_token' not in token_data:
+                raise HTTPException(status_code=400, detail="Allegro nie zwróciło 'access_token'.")
+            return token_data
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=400, detail=f"HTTP Ошибка от Allegro: {e.response.text}")
 
     # ---  МЕТОД ДЛЯ ОБНОВЛЕНИЯ ТОКЕНА ---
     async def refresh_tokens(self, refresh_token: str) -> dict | None:
@@ -48,10 +51,10 @@ class AllegroService:
             "refresh_token": refresh_token
         }
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(f"{self.auth_url}/token", auth=auth_header, data=data)
-                response.raise_for_status()
-                return response.json()
+            client = get_http_client()
+            response = await client.post(f"{self.auth_url}/token", auth=auth_header, data=data)
+            response.raise_for_status()
+            return response.json()
         except httpx.HTTPStatusError as e:
             logger.error(
                 "Не удалось обновить токен Allegro через refresh_token",
@@ -62,8 +65,7 @@ class AllegroService:
 
     async def get_allegro_user_details(self, access_token: str) -> dict:
         headers = {"Authorization": f"Bearer {access_token}", "Accept": "application/vnd.allegro.public.v1+json"}
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{self.api_url}/me", headers=headers)
+        response = await get_http_client().get(f"{self.api_url}/me", headers=headers)
         if response.status_code != 200:
             raise HTTPException(status_code=400, detail="Nie udało się pobrać danych użytkownika Allegro.")
         return response.json()
@@ -102,6 +104,9 @@ class AllegroService:
                 expires_at=expires_at
             )
             db.add(db_account)
+            await db.flush()
+            # Новый аккаунт сразу попадает в очередь, не дожидаясь планировщика
+            await TaskQueueService(db).enqueue_account(db_account.id)
 
         await db.commit()
         await db.refresh(db_account)
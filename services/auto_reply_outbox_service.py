@@ -0,0 +1,234 @@
+# services/auto_reply_outbox_service.py
+import asyncio
+from collections import defaultdict
+from typing import List, Optional, Sequence, Tuple
+from fastapi import HTTPException, status
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.models import AllegroAccount
+from models.database import AsyncSessionLocal
+from services.allegro_client import AllegroClient, MESSAGES_PAGE_LIMIT, parse_allegro_datetime
+from services.conversation_mirror_service import ConversationMirrorService, THREAD
+from utils.logger import logger
+from config import settings
+
+# Ошибки 4xx, кроме этих, постоянные (диалог закрыт, текст отклонен и т.п.) и не повторяются
+_RETRYABLE_STATUSES = {status.HTTP_408_REQUEST_TIMEOUT, status.HTTP_409_CONFLICT, status.HTTP_429_TOO_MANY_REQUESTS}
+
+
+def reply_idempotency_key(account_id: int, thread_id: str, last_message_at) -> str:
+    """Один автоответ на одно сообщение покупателя."""
+    return f"{account_id}:{thread_id}:{last_message_at.isoformat()}"
+
+
+class AutoReplyOutboxService:
+    """Операции над таблицей auto_reply_outbox, выполняемые пачками."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def enqueue(self, account_id: int, replies: Sequence[Tuple[str, str, str]]) -> int:
+        """
+        Записывает намерения ответить (thread_id, текст, ключ идемпотентности) одним INSERT.
+        Вызывается в транзакции, фиксирующей auto_reply_log, поэтому ответ либо записан
+        вместе с логом, либо не записан вовсе. Повторный ключ игнорируется.
+        """
+        if not replies:
+            return 0
+        stmt = text("""
+            INSERT INTO auto_reply_outbox (allegro_account_id, thread_id, body, idempotency_key)
+            SELECT CAST(:account_id AS integer), r.thread_id, r.body, r.idempotency_key
+            FROM unnest(
+                CAST(:thread_ids AS text[]),
+                CAST(:bodies AS text[]),
+                CAST(:keys AS text[])
+            ) AS r(thread_id, body, idempotency_key)
+            ON CONFLICT (idempotency_key) DO NOTHING;
+        """)
+        result = await self.db.execute(stmt, {
+            "account_id": account_id,
+            "thread_ids": [thread_id for thread_id, _, _ in replies],
+            "bodies": [body for _, body, _ in replies],
+            "keys": [key for _, _, key in replies],
+        })
+        return result.rowcount
+
+    async def claim_batch(self, limit: int, shard_index: int = 0, shard_count: int = 1) -> list:
+        """
+        Забирает до limit готовых к отправке ответов и выдает на них аренду.
+        Ответы с истекшей арендой (отправитель упал) забираются повторно.
+        needs_check отмечает ответы, которые могли уже дойти до Allegro: прошлая попытка
+        оборвалась (аренда истекла) или завершилась ошибкой после отправки запроса.
+        """
+        stmt = text("""
+            UPDATE auto_reply_outbox AS o
+            SET status = 'sending',
+                locked_until = NOW() + make_interval(secs => CAST(:lease AS integer))
+            FROM (
+                SELECT id, status = 'sending' OR attempts > 0 AS needs_check FROM auto_reply_outbox
+                WHERE ((status = 'pending' AND next_attempt_at <= NOW())
+                        OR (status = 'sending' AND locked_until < NOW()))
+                    AND allegro_account_id % CAST(:shard_count AS integer) = CAST(:shard_index AS integer)
+                ORDER BY next_attempt_at
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            ) AS c
+            WHERE o.id = c.id
+            RETURNING o.id, o.allegro_account_id, o.thread_id, o.body, o.created_at, c.needs_check;
+        """)
+        result = await self.db.execute(stmt, {
+            "limit": limit,
+            "lease": settings.AUTO_REPLY_OUTBOX_LEASE_SECONDS,
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+        })
+        return result.all()
+
+    async def complete_batch(self, results: Sequence[Tuple[int, bool, bool, Optional[str]]]) -> int:
+        """
+        Записывает итоги отправки (id, отправлено, можно повторить, ошибка) одним UPDATE.
+        Повторяемые ошибки откладываются с экспоненциальным backoff, пока не исчерпаны попытки.
+        """
+        if not results:
+            return 0
+        stmt = text("""
+            UPDATE auto_reply_outbox AS o
+            SET status = CASE
+                    WHEN r.sent THEN 'sent'
+                    WHEN r.retryable AND o.attempts + 1 < CAST(:max_attempts AS integer) THEN 'pending'
+                    ELSE 'failed'
+                END,
+                attempts = CASE WHEN r.sent THEN o.attempts ELSE o.attempts + 1 END,
+                sent_at = CASE WHEN r.sent THEN NOW() ELSE NULL END,
+                last_error = r.error,
+                locked_until = NULL,
+                next_attempt_at = NOW() + make_interval(secs => LEAST(
+                    CAST(:retry_base AS float8) * power(2, o.attempts),
+                    CAST(:retry_max AS float8)
+                ))
+            FROM unnest(
+                CAST(:ids AS bigint[]),
+                CAST(:sent AS boolean[]),
+                CAST(:retryable AS boolean[]),
+                CAST(:errors AS text[])
+            ) AS r(id, sent, retryable, error)
+            WHERE o.id = r.id;
+        """)
+        result = await self.db.execute(stmt, {
+            "ids": [outbox_id for outbox_id, _, _, _ in results],
+            "sent": [sent for _, sent, _, _ in results],
+            "retryable": [retryable for _, _, retryable, _ in results],
+            "errors": [error for _, _, _, error in results],
+            "max_attempts": settings.AUTO_REPLY_OUTBOX_MAX_ATTEMPTS,
+            "retry_base": settings.AUTO_REPLY_OUTBOX_RETRY_BASE_SECONDS,
+            "retry_max": settings.AUTO_REPLY_OUTBOX_RETRY_MAX_SECONDS,
+        })
+        return result.rowcount
+
+
+class AutoReplySender:
+    """
+    Отправляет автоответы из outbox. Ответы одного аккаунта уходят последовательно,
+    разные аккаунты - параллельно; темп задает общий лимитер запросов к Allegro.
+    """
+
+    def __init__(self, shard_index: int = 0, shard_count: int = 1):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.semaphore = asyncio.Semaphore(settings.AUTO_REPLY_OUTBOX_SEND_CONCURRENCY)
+
+    async def send_pending(self) -> int:
+        """Отправляет одну пачку ответов. Возвращает количество взятых в работу записей."""
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                batch = await AutoReplyOutboxService(db).claim_batch(
+                    settings.AUTO_REPLY_OUTBOX_BATCH_SIZE, self.shard_index, self.shard_count)
+                if not batch:
+                    return 0
+                account_ids = {row.allegro_account_id for row in batch}
+                accounts = {
+                    account.id: account for account in (await db.execute(
+                        select(AllegroAccount).where(AllegroAccount.id.in_(account_ids))
+                    )).scalars().all()
+                }
+
+        by_account = defaultdict(list)
+        for row in batch:
+            by_account[row.allegro_account_id].append(row)
+
+        results = []
+        sent_messages = []
+        for account_results, account_sent in await asyncio.gather(*(
+            self._send_account_replies(accounts.get(account_id), rows) for account_id, rows in by_account.items()
+        )):
+            results.extend(account_results)
+            sent_messages.extend(account_sent)
+
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                await AutoReplyOutboxService(db).complete_batch(results)
+
+        # Локальная копия - отдельной транзакцией: ее сбой не должен откатить статус 'sent'
+        # и привести к повторной отправке уже доставленных ответов после истечения аренды
+        if sent_messages:
+            try:
+                async with AsyncSessionLocal() as db:
+                    async with db.begin():
+                        mirror = ConversationMirrorService(db)
+                        for account_id, thread_id, raw_message in sent_messages:
+                            await mirror.record_sent_message(account_id, THREAD, thread_id, raw_message)
+            except Exception as e:
+                logger.warning("Не удалось записать отправленные автоответы в локальную копию",
+                               count=len(sent_messages), details=str(e))
+        return len(batch)
+
+    async def _send_account_replies(self, allegro_account: Optional[AllegroAccount],
+                                    rows: list) -> Tuple[List[tuple], List[tuple]]:
+        """Возвращает итоги отправки для outbox и отправленные сообщения для локальной копии."""
+        if allegro_account is None:
+            return [(row.id, False, False, "Allegro account not found") for row in rows], []
+
+        client = AllegroClient(db=None, allegro_account=allegro_account)
+        results = []
+        sent_messages = []
+        async with self.semaphore:
+            for row in rows:
+                try:
+                    raw_message = await self._find_sent_reply(client, row) if row.needs_check else None
+                    if raw_message is not None:
+                        results.append((row.id, True, False, None))
+                        sent_messages.append((allegro_account.id, row.thread_id, raw_message))
+                        logger.info("Автоответ уже был доставлен прошлой попыткой", thread_id=row.thread_id,
+                                    account_id=allegro_account.id)
+                        continue
+                    raw_message = await client.post_thread_message(row.thread_id, row.body)
+                    results.append((row.id, True, False, None))
+                    sent_messages.append((allegro_account.id, row.thread_id, raw_message))
+                    logger.info("Автоответ отправлен", thread_id=row.thread_id, account_id=allegro_account.id)
+                except HTTPException as e:
+                    retryable = e.status_code >= 500 or e.status_code in _RETRYABLE_STATUSES
+                    results.append((row.id, False, retryable, str(e.detail)))
+                    logger.error("Не удалось отправить автоответ", thread_id=row.thread_id,
+                                 account_id=allegro_account.id, status_code=e.status_code)
+                except Exception as e:
+                    results.append((row.id, False, True, str(e)))
+                    logger.error("Не удалось отправить автоответ", thread_id=row.thread_id,
+                                 account_id=allegro_account.id, details=str(e))
+        return results, sent_messages
+
+    @staticmethod
+    async def _find_sent_reply(client: AllegroClient, row) -> Optional[dict]:
+        """
+        Ищет среди последних сообщений диалога ответ продавца с тем же текстом, созданный
+        после постановки в outbox. Allegro не принимает ключ идемпотентности, поэтому
+        без этой проверки ответ, принятый перед обрывом попытки, ушел бы повторно.
+        Остается узкое окно at-least-once: сообщение, еще не видимое в диалоге.
+        """
+        data = await client.get_thread_messages(row.thread_id, limit=MESSAGES_PAGE_LIMIT)
+        for raw_message in data.get("messages", []):
+            created_at = parse_allegro_datetime(raw_message.get("createdAt"))
+            if ((raw_message.get("author") or {}).get("role") == "SELLER"
+                    and (raw_message.get("text") or "").strip() == row.body.strip()
+                    and created_at is not None and created_at >= row.created_at):
+                return raw_message
+        return None
@@ -1,77 +1,294 @@
 # services/auto_responder_service.py
+import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete
+from sqlalchemy import select, func, any_, bindparam, String
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.orm import joinedload
+from typing import Dict, List, Optional, Set, Tuple
 from datetime import datetime, timedelta, timezone
 from pydantic import ValidationError
-from models.models import AllegroAccount, AutoReplyLog, User, MessageMetadata
-from services.allegro_client import AllegroClient
-from services.notification_service import send_notification
-from schemas.allegro_api import ThreadsResponse, MessagesResponse, AllegroThread
+from models.models import AllegroAccount, AutoReplyLog, AccountSyncState
+from services.allegro_client import AllegroClient, THREADS_PAGE_LIMIT, MESSAGES_PAGE_LIMIT, parse_allegro_datetime
+from services.conversation_mirror_service import ConversationMirrorService, THREAD, ISSUE
+from services.auto_reply_outbox_service import AutoReplyOutboxService, reply_idempotency_key
+from services.notification_service import notification_dispatcher, claim_push_slot
+from schemas.allegro_api import MessagesResponse, AllegroThread
 from utils.logger import logger
+from config import settings
 
 class AutoResponderService:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def process_single_account(self, account_id: int):
-        query = select(AllegroAccount).join(User, AllegroAccount.owner_id == User.id).where(
-            AllegroAccount.id == account_id).with_for_update()
-
-        allegro_account = (await self.db.execute(query)).scalar_one_or_none()
+    async def process_single_account(self, account_id: int) -> int:
+        """
+        Обрабатывает аккаунт и возвращает количество новых диалогов от покупателей.
+        Работа разбита на фазы, чтобы соединение с БД и блокировки не удерживались
+        во время запросов к Allegro: короткое чтение, сетевой обмен, короткая запись.
+        Синхронизация инкрементальная: просматриваются только диалоги, изменившиеся
+        после водяного знака из account_sync_state.
+        """
+        async with self.db.begin():
+            query = select(AllegroAccount).options(joinedload(AllegroAccount.owner)).where(
+                AllegroAccount.id == account_id)
+            allegro_account = (await self.db.execute(query)).scalar_one_or_none()
+            sync_state = await self.db.get(AccountSyncState, account_id)
 
         if not allegro_account:
             logger.warning(f"Аккаунт с ID {account_id} не найден во время обработки задачи.", account_id=account_id)
-            return
+            return 0
 
-        client = AllegroClient(db=self.db, allegro_account=allegro_account)
+        # Клиент без сессии: обновленные токены он сохраняет собственной короткой транзакцией
+        client = AllegroClient(db=None, allegro_account=allegro_account)
         account_login = allegro_account.allegro_login
-        fcm_token = allegro_account.owner.fcm_token
-        auto_reply_enabled = allegro_account.auto_reply_enabled
-        reply_text = allegro_account.auto_reply_text
 
         logger.info(f"Обрабатываем аккаунт: {account_login}", account_id=account_id)
+        watermark = sync_state.last_message_at if sync_state else None
+        watermark_thread_ids = set(sync_state.last_thread_ids) if sync_state else set()
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=settings.AUTO_RESPONDER_LOOKBACK_HOURS)
+        if watermark is not None and watermark > cutoff:
+            cutoff = watermark
+        newest_at = None
+        newest_thread_ids = set()
+        new_threads = []
+        replies = []
+        seen_threads = []
+        fetched_messages: Dict[str, list] = {}
+        sync_complete = False
+        listing_synced = False
+        truncated = False
+        reached_cutoff = False
+        # Граница окна списка, которое покрыл проход: диалоги новее нее в копии актуальны,
+        # включая флаг read. None - проход дошел до конца списка.
+        covered_since: Optional[datetime] = None
+
+        def is_before_cutoff(raw_thread: dict) -> bool:
+            nonlocal reached_cutoff
+            last_message_at = parse_allegro_datetime(raw_thread.get('lastMessageDateTime'))
+            if last_message_at is not None and last_message_at < cutoff:
+                reached_cutoff = True
+            return reached_cutoff
+
+        def stop_walk(raw_thread: dict) -> bool:
+            # Первую страницу читаем целиком даже за cutoff, чтобы ее могла отдавать локальная копия
+            nonlocal covered_since
+            if not is_before_cutoff(raw_thread) or len(seen_threads) < THREADS_PAGE_LIMIT:
+                return False
+            covered_since = parse_allegro_datetime(raw_thread.get('lastMessageDateTime')) or cutoff
+            return True
+
+        def on_truncated():
+            nonlocal truncated
+            truncated = True
 
         try:
-            raw_threads_data = await client.get_threads(limit=20, offset=0)
-            try:
-                threads_response = ThreadsResponse.model_validate(raw_threads_data)
-            except ValidationError as e:
-                logger.error(f"Ошибка валидации ответа Allegro (threads)", details=str(e), account_id=account_id)
-                return
-
-            for thread in threads_response.threads:
-                if not thread.read and await self._is_new_message_from_buyer(client, thread, account_id):
-                    logger.info(f"Обнаружен новый непрочитанный диалог", thread_id=thread.id)
-                    if fcm_token:
-                        try:
-                            interlocutor = thread.interlocutor.login if thread.interlocutor else 'Kupujący'
-                            title = f"Nowa wiadomość od {interlocutor}"
-                            body = f"Konto: {account_login}. Kliknij, aby odpowiedzieć."
-                            send_notification(token=fcm_token, title=title, body=body)
-                        except Exception as e:
-                            logger.error(f"Ошибка при отправке PUSH-уведомления", details=str(e))
-                    if auto_reply_enabled and reply_text:
-                        logger.info(f"Автоответчик включен. Отправляем ответ.", thread_id=thread.id)
-                        await client.post_thread_message(thread.id, reply_text)
-                    await self._log_conversation_as_processed(thread.id, account_id)
-                    logger.info(f"Диалог помечен как обработанный.", thread_id=thread.id)
+            # Диалоги идут от новых к старым: листаем, пока не дойдем до водяного знака
+            # (или окна просмотра), и обрабатываем непрочитанные порциями. Диалоги первой
+            # страницы старше cutoff только записываются в локальную копию.
+            complete = True
+            unread_threads = []
+            async for raw_thread in client.iter_threads(stop=stop_walk, max_pages=settings.AUTO_RESPONDER_MAX_PAGES,
+                                                        on_truncated=on_truncated):
+                seen_threads.append(raw_thread)
+                if is_before_cutoff(raw_thread):
+                    continue
+                try:
+                    thread = AllegroThread.model_validate(raw_thread)
+                except ValidationError as e:
+                    logger.error(f"Ошибка валидации ответа Allegro (threads)", details=str(e), account_id=account_id)
+                    continue
+
+                if newest_at is None or thread.last_message_date_time > newest_at:
+                    newest_at = thread.last_message_date_time
+                    newest_thread_ids = {thread.id}
+                elif thread.last_message_date_time == newest_at:
+                    newest_thread_ids.add(thread.id)
+
+                if thread.last_message_date_time == watermark and thread.id in watermark_thread_ids:
+                    continue
+                if thread.read:
+                    continue
+                unread_threads.append(thread)
+                if len(unread_threads) >= THREADS_PAGE_LIMIT:
+                    complete &= await self._process_unread_threads(
+                        client, allegro_account, unread_threads, new_threads, replies, fetched_messages)
+                    unread_threads = []
+            if unread_threads:
+                complete &= await self._process_unread_threads(
+                    client, allegro_account, unread_threads, new_threads, replies, fetched_messages)
+            if truncated and not reached_cutoff:
+                # Лимит страниц исчерпан раньше водяного знака: более старые диалоги не просмотрены,
+                # поэтому водяной знак не двигаем и следующий цикл снова дойдет до них
+                logger.warning("Достигнут лимит страниц до водяного знака, проход неполный",
+                               account_id=account_id, max_pages=settings.AUTO_RESPONDER_MAX_PAGES)
+            sync_complete = complete and (reached_cutoff or not truncated)
+            listing_synced = not truncated
         except Exception as e:
             logger.error(f"Критическая ошибка при обработке аккаунта {account_login}", details=str(e), exc_info=True)
             raise e
+        finally:
+            # Обработанные диалоги и ответы для outbox фиксируем одной транзакцией, даже при ошибке
+            # на следующем диалоге. Водяной знак двигаем только после полного успешного прохода.
+            processed_thread_ids = [thread.id for thread in new_threads]
+            advance_watermark = sync_complete and newest_at is not None
+            fcm_token = allegro_account.owner.fcm_token
+            push_allowed, suppressed = False, 0
+            if processed_thread_ids or advance_watermark or seen_threads:
+                async with self.db.begin():
+                    # Локальная копия диалогов для эндпоинтов чтения обновляется тем же циклом
+                    mirror = ConversationMirrorService(self.db)
+                    await mirror.upsert_conversations(account_id, THREAD, seen_threads)
+                    for thread_id, raw_messages in fetched_messages.items():
+                        await mirror.upsert_messages(account_id, THREAD, thread_id, raw_messages)
+                        await mirror.mark_messages_synced(account_id, THREAD, thread_id)
+                    if listing_synced:
+                        if covered_since is None:
+                            await mirror.prune_listing(account_id, THREAD)
+                        await mirror.mark_listing_synced(account_id, THREAD, covered_since)
+                    await self._log_conversations_as_processed(account_id, processed_thread_ids)
+                    await AutoReplyOutboxService(self.db).enqueue(account_id, replies)
+                    if advance_watermark:
+                        await self._save_sync_cursor(account_id, newest_at, newest_thread_ids)
+                    if new_threads and fcm_token:
+                        push_allowed, suppressed = await claim_push_slot(self.db, fcm_token, len(new_threads))
+                if processed_thread_ids:
+                    logger.info(f"Диалоги помечены как обработанные.", thread_ids=processed_thread_ids)
+            if push_allowed:
+                self._notify_new_threads(fcm_token, account_login, new_threads, suppressed)
+
+        await self._sync_issues(client, account_id, sync_state)
+        return len(new_threads)
+
+    async def _sync_issues(self, client: AllegroClient, account_id: int, sync_state: Optional[AccountSyncState]):
+        """
+        Обновляет локальную копию обсуждений полным проходом, если прошлый проход старше
+        MIRROR_ISSUES_SYNC_INTERVAL_SECONDS. Ошибки не прерывают обработку аккаунта.
+        """
+        synced_at = sync_state.issues_synced_at if sync_state else None
+        interval = timedelta(seconds=settings.MIRROR_ISSUES_SYNC_INTERVAL_SECONDS)
+        if synced_at is not None and datetime.now(timezone.utc) - synced_at < interval:
+            return
+
+        truncated = False
+
+        def on_truncated():
+            nonlocal truncated
+            truncated = True
+
+        try:
+            issues = [raw_issue async for raw_issue in client.iter_issues(
+                max_pages=settings.MIRROR_FULL_SYNC_MAX_PAGES, on_truncated=on_truncated)]
+            async with self.db.begin():
+                mirror = ConversationMirrorService(self.db)
+                await mirror.upsert_conversations(account_id, ISSUE, issues)
+                if not truncated:
+                    await mirror.prune_listing(account_id, ISSUE)
+                    await mirror.mark_listing_synced(account_id, ISSUE)
+        except Exception as e:
+            logger.warning("Не удалось обновить локальную копию обсуждений", account_id=account_id, details=str(e))
 
-    async def _is_new_message_from_buyer(self, client: AllegroClient, thread: AllegroThread, account_id: int) -> bool:
+    def _notify_new_threads(self, fcm_token: str, account_login: str, new_threads: List[AllegroThread],
+                            suppressed: int):
+        """Одно сводное уведомление на аккаунт за цикл (плюс подавленные троттлингом ранее)."""
+        total = len(new_threads) + suppressed
+        if total == 1:
+            thread = new_threads[0]
+            interlocutor = thread.interlocutor.login if thread.interlocutor else 'Kupujący'
+            title = f"Nowa wiadomość od {interlocutor}"
+        else:
+            title = f"Nowe wiadomości: {total}"
+        body = f"Konto: {account_login}. Kliknij, aby odpowiedzieć."
+        try:
+            notification_dispatcher.enqueue(token=fcm_token, title=title, body=body)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке PUSH-уведомления", details=str(e))
+
+    async def _save_sync_cursor(self, account_id: int, last_message_at: datetime, thread_ids: Set[str]):
+        stmt = pg_insert(AccountSyncState).values(
+            allegro_account_id=account_id,
+            last_message_at=last_message_at,
+            last_thread_ids=sorted(thread_ids),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AccountSyncState.allegro_account_id],
+            set_={
+                "last_message_at": stmt.excluded.last_message_at,
+                "last_thread_ids": stmt.excluded.last_thread_ids,
+                "updated_at": func.now(),
+            },
+        )
+        await self.db.execute(stmt)
+
+    async def _process_unread_threads(self, client: AllegroClient, allegro_account: AllegroAccount,
+                                      unread_threads: List[AllegroThread], new_threads: List[AllegroThread],
+                                      replies: List[Tuple[str, str, str]],
+                                      fetched_messages: Dict[str, list]) -> bool:
+        """
+        Находит новые сообщения от покупателей: диалоги добавляет в new_threads (по ним
+        в конце цикла уходит одно сводное уведомление), а автоответы - в replies
+        (их отправит отдельный этап воркера через outbox). Полученные последние страницы
+        сообщений складывает в fetched_messages для локальной копии.
+        Возвращает False, если какой-то диалог не удалось проверить (его нужно пересмотреть позже).
+        """
+        account_id = allegro_account.id
+        auto_reply_enabled = allegro_account.auto_reply_enabled
+        reply_text = allegro_account.auto_reply_text
+        complete = True
+
+        async with self.db.begin():
+            already_processed = await self._get_processed_thread_ids(
+                account_id, [thread.id for thread in unread_threads])
+
+        # Последние сообщения всех кандидатов запрашиваем параллельно (с ограничением на аккаунт),
+        # а решения об ответе принимаем уже по собранным результатам
+        candidates = [thread for thread in unread_threads if thread.id not in already_processed]
+        semaphore = asyncio.Semaphore(settings.AUTO_RESPONDER_CHECK_CONCURRENCY)
+
+        async def check(thread: AllegroThread) -> Optional[bool]:
+            async with semaphore:
+                return await self._is_new_message_from_buyer(client, thread, fetched_messages)
+
+        checks = await asyncio.gather(*(check(thread) for thread in candidates))
+
+        for thread, is_new in zip(candidates, checks):
+            if is_new is None:
+                complete = False
+                continue
+            if not is_new:
+                continue
+            logger.info(f"Обнаружен новый непрочитанный диалог", thread_id=thread.id)
+            if auto_reply_enabled and reply_text:
+                logger.info(f"Автоответчик включен. Ставим ответ в очередь.", thread_id=thread.id)
+                replies.append((thread.id, reply_text,
+                                reply_idempotency_key(account_id, thread.id, thread.last_message_date_time)))
+            new_threads.append(thread)
+        return complete
+
+    async def _get_processed_thread_ids(self, account_id: int, thread_ids: List[str]) -> Set[str]:
+        # Один запрос на всю порцию: conversation_id = ANY(:ids) с массивом в одном параметре
+        result = await self.db.execute(
+            select(AutoReplyLog.conversation_id).where(
+                AutoReplyLog.allegro_account_id == account_id,
+                AutoReplyLog.conversation_id == any_(bindparam("thread_ids", thread_ids, type_=ARRAY(String)))
+            )
+        )
+        return set(result.scalars().all())
+
+    async def _is_new_message_from_buyer(self, client: AllegroClient, thread: AllegroThread,
+                                         fetched_messages: Dict[str, list]) -> Optional[bool]:
+        """
+        Последнее сообщение диалога от покупателя? None - если проверить не удалось.
+        Запрашивается целая последняя страница, чтобы сразу обновить ею локальную копию.
+        """
         thread_id = thread.id
-        log_entry = await self.db.execute(select(AutoReplyLog).where(AutoReplyLog.conversation_id == thread_id,
-                                                                     AutoReplyLog.allegro_account_id == account_id))
-        if log_entry.scalar_one_or_none():
-            return False
         try:
-            raw_messages_data = await client.get_thread_messages(thread_id, limit=1)
+            raw_messages_data = await client.get_thread_messages(thread_id, limit=MESSAGES_PAGE_LIMIT)
             try:
                 messages_response = MessagesResponse.model_validate(raw_messages_data)
             except ValidationError as e:
                 logger.error("Ошибка валидации ответа Allegro (messages)", thread_id=thread_id, details=str(e))
                 return False
+            fetched_messages[thread_id] = raw_messages_data.get("messages", [])
 
             if not messages_response.messages:
                 return False
@@ -81,32 +298,18 @@ class AutoResponderService:
                 return True
         except Exception as e:
             logger.error("Не удалось проверить сообщения для диалога", thread_id=thread_id, details=str(e))
-            return False
+            return None
         return False
 
-    async def _log_conversation_as_processed(self, thread_id: str, account_id: int):
-        new_log = AutoReplyLog(conversation_id=thread_id, allegro_account_id=account_id)
-        self.db.add(new_log)
-
-    async def cleanup_old_logs(self):
-        try:
-            thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-            stmt = delete(AutoReplyLog).where(AutoReplyLog.reply_time < thirty_days_ago)
-            result = await self.db.execute(stmt)
-            await self.db.commit()
-            logger.info("Очистка логов автоответчика завершена", deleted_rows=result.rowcount)
-        except Exception as e:
-            logger.error("ОШИБКА во время очистки логов автоответчика:", details=str(e))
-            await self.db.rollback()
-
-    async def cleanup_old_message_metadata(self):
-        try:
-            retention_period_days = 90
-            ninety_days_ago = datetime.now(timezone.utc) - timedelta(days=retention_period_days)
-            stmt = delete(MessageMetadata).where(MessageMetadata.sent_at < ninety_days_ago)
-            result = await self.db.execute(stmt)
-            await self.db.commit()
-            logger.info("Очистка метаданных сообщений завершена", deleted_rows=result.rowcount)
-        except Exception as e:
-            logger.error("ОШИБКА во время очистки метаданных сообщений", details=str(e))
-            await self.db.rollback()
\ No newline at end of file
+    async def _log_conversations_as_processed(self, account_id: int, thread_ids: List[str]):
+        """Записывает обработанные диалоги одним многострочным INSERT ... ON CONFLICT."""
+        if not thread_ids:
+            return
+        stmt = pg_insert(AutoReplyLog).values([
+            {"conversation_id": thread_id, "allegro_account_id": account_id} for thread_id in thread_ids
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[AutoReplyLog.conversation_id, AutoReplyLog.allegro_account_id],
+            set_={"reply_time": func.now()},
+        )
+        await self.db.execute(stmt)
@@ -0,0 +1,218 @@
+# services/conversation_mirror_service.py
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.models import AccountSyncState, AllegroConversation, AllegroMessageMirror
+from services.allegro_client import parse_allegro_datetime
+from config import settings
+
+THREAD = "thread"
+ISSUE = "issue"
+
+# Ключ списка в ответе Allegro и поле времени последней активности для каждого вида
+_LISTING_KEYS = {THREAD: "threads", ISSUE: "issues"}
+_LAST_ACTIVITY_FIELDS = {THREAD: "lastMessageDateTime", ISSUE: "lastUpdateDateTime"}
+
+
+class ConversationMirrorService:
+    """
+    Локальная копия диалогов, обсуждений и сообщений Allegro. Запись идет пачками
+    (INSERT ... ON CONFLICT), чтение отдает данные только если копия достаточно свежая;
+    иначе get_* возвращают None, и вызывающий код идет в Allegro напрямую.
+    Страницы списка отдаются только из окна, которое покрыл последний проход воркера
+    (весь список или диалоги новее его границы): вне окна могут быть устаревшими флаги
+    read. Отдельные страницы, полученные из Allegro по запросу, лишь обновляют строки копии.
+    """
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    # --- Запись ---
+
+    async def upsert_conversations(self, account_id: int, kind: str, raw_items: Iterable[dict]):
+        items = [item for item in raw_items if item.get("id")]
+        if not items:
+            return
+        activity_field = _LAST_ACTIVITY_FIELDS[kind]
+        stmt = text("""
+            INSERT INTO allegro_conversations (allegro_account_id, kind, id, last_message_at, read, raw, synced_at)
+            SELECT CAST(:account_id AS integer), CAST(:kind AS text), c.id, c.last_message_at, c.read,
+                   CAST(c.raw AS jsonb), NOW()
+            FROM unnest(
+                CAST(:ids AS text[]),
+                CAST(:last_message_at AS timestamptz[]),
+                CAST(:read AS boolean[]),
+                CAST(:raw AS text[])
+            ) AS c(id, last_message_at, read, raw)
+            ON CONFLICT (allegro_account_id, kind, id) DO UPDATE
+                SET last_message_at = EXCLUDED.last_message_at,
+                    read = EXCLUDED.read,
+                    raw = EXCLUDED.raw,
+                    synced_at = EXCLUDED.synced_at;
+        """)
+        await self.db.execute(stmt, {
+            "account_id": account_id,
+            "kind": kind,
+            "ids": [item["id"] for item in items],
+            "last_message_at": [parse_allegro_datetime(item.get(activity_field)) for item in items],
+            "read": [item.get("read") for item in items],
+            "raw": [json.dumps(item) for item in items],
+        })
+
+    async def upsert_messages(self, account_id: int, kind: str, conversation_id: str, raw_messages: Iterable[dict]):
+        messages = [message for message in raw_messages if message.get("id")]
+        if not messages:
+            return
+        stmt = text("""
+            INSERT INTO allegro_messages (allegro_account_id, id, conversation_kind, conversation_id,
+                                          created_at, author_login, text, raw, synced_at)
+            SELECT CAST(:account_id AS integer), m.id, CAST(:kind AS text), CAST(:conversation_id AS text),
+                   m.created_at, m.author_login, m.text, CAST(m.raw AS jsonb), NOW()
+            FROM unnest(
+                CAST(:ids AS text[]),
+                CAST(:created_at AS timestamptz[]),
+                CAST(:author_logins AS text[]),
+                CAST(:texts AS text[]),
+                CAST(:raw AS text[])
+            ) AS m(id, created_at, author_login, text, raw)
+            ON CONFLICT (allegro_account_id, id) DO UPDATE
+                SET text = EXCLUDED.text,
+                    raw = EXCLUDED.raw,
+                    synced_at = EXCLUDED.synced_at;
+        """)
+        await self.db.execute(stmt, {
+            "account_id": account_id,
+            "kind": kind,
+            "conversation_id": conversation_id,
+            "ids": [message["id"] for message in messages],
+            "created_at": [parse_allegro_datetime(message.get("createdAt")) for message in messages],
+            "author_logins": [(message.get("author") or {}).get("login") for message in messages],
+            "texts": [message.get("text") for message in messages],
+            "raw": [json.dumps(message) for message in messages],
+        })
+
+    async def mark_messages_synced(self, account_id: int, kind: str, conversation_id: str):
+        """Последняя страница сообщений только что получена из Allegro целиком."""
+        await self.db.execute(text("""
+            UPDATE allegro_conversations SET messages_synced_at = NOW()
+            WHERE allegro_account_id = :account_id AND kind = :kind AND id = :conversation_id;
+        """), {"account_id": account_id, "kind": kind, "conversation_id": conversation_id})
+
+    async def record_sent_message(self, account_id: int, kind: str, conversation_id: str, raw_message: dict):
+        """
+        Добавляет отправленное сообщение в копию. Если сообщения диалога были синхронизированы
+        до этого момента, копия остается полной и сдвигается вместе с диалогом.
+        """
+        await self.upsert_messages(account_id, kind, conversation_id, [raw_message])
+        sent_at = parse_allegro_datetime(raw_message.get("createdAt")) or datetime.now(timezone.utc)
+        await self.db.execute(text("""
+            UPDATE allegro_conversations
+            SET messages_synced_at = CASE
+                    WHEN messages_synced_at >= last_message_at THEN GREATEST(messages_synced_at, :sent_at)
+                    ELSE messages_synced_at
+                END,
+                last_message_at = GREATEST(last_message_at, :sent_at)
+            WHERE allegro_account_id = :account_id AND kind = :kind AND id = :conversation_id;
+        """), {"account_id": account_id, "kind": kind, "conversation_id": conversation_id, "sent_at": sent_at})
+
+    async def prune_listing(self, account_id: int, kind: str):
+        """
+        Удаляет из копии диалоги, не встреченные в только что завершенном полном проходе.
+        Вызывается в транзакции, где upsert_conversations записал все элементы прохода:
+        их synced_at равен NOW() этой транзакции.
+        """
+        await self.db.execute(text("""
+            DELETE FROM allegro_conversations
+            WHERE allegro_account_id = :account_id AND kind = :kind AND synced_at < NOW();
+        """), {"account_id": account_id, "kind": kind})
+
+    async def mark_listing_synced(self, account_id: int, kind: str, covered_since: Optional[datetime] = None):
+        """
+        Отмечает проход воркера по списку: копия актуальна на текущий момент для элементов
+        новее covered_since, а при covered_since = None (проход дошел до конца) - целиком.
+        Число элементов списка обновляется только после полного прохода.
+        """
+        key = _LISTING_KEYS[kind]
+        await self.db.execute(text(f"""
+            INSERT INTO account_sync_state (allegro_account_id, {key}_synced_at, {key}_covered_since, {key}_total_count)
+            SELECT :account_id, NOW(), CAST(:covered_since AS timestamptz),
+                   CASE WHEN CAST(:covered_since AS timestamptz) IS NULL THEN count(*) END
+            FROM allegro_conversations
+            WHERE allegro_account_id = :account_id AND kind = :kind
+            ON CONFLICT (allegro_account_id) DO UPDATE
+                SET {key}_synced_at = EXCLUDED.{key}_synced_at,
+                    {key}_covered_since = EXCLUDED.{key}_covered_since,
+                    {key}_total_count = COALESCE(EXCLUDED.{key}_total_count, account_sync_state.{key}_total_count);
+        """), {"account_id": account_id, "kind": kind, "covered_since": covered_since})
+
+    # --- Чтение ---
+
+    def _is_fresh(self, synced_at: Optional[datetime]) -> bool:
+        max_age = timedelta(seconds=settings.MIRROR_MAX_AGE_SECONDS)
+        return synced_at is not None and datetime.now(timezone.utc) - synced_at <= max_age
+
+    async def _listing_synced_at(self, account_id: int, kind: str) -> Optional[datetime]:
+        sync_state = await self.db.get(AccountSyncState, account_id)
+        return getattr(sync_state, f"{_LISTING_KEYS[kind]}_synced_at", None) if sync_state else None
+
+    async def get_listing(self, account_id: int, kind: str, limit: int, offset: int) -> Optional[dict]:
+        """
+        Страница списка в формате ответа Allegro или None, если проход воркера устарел
+        или страница выходит за покрытое им окно.
+        """
+        key = _LISTING_KEYS[kind]
+        sync_state = await self.db.get(AccountSyncState, account_id)
+        synced_at = getattr(sync_state, f"{key}_synced_at", None) if sync_state else None
+        if not self._is_fresh(synced_at):
+            return None
+
+        rows = (await self.db.execute(
+            select(AllegroConversation.raw, AllegroConversation.last_message_at)
+            .where(AllegroConversation.allegro_account_id == account_id, AllegroConversation.kind == kind)
+            .order_by(AllegroConversation.last_message_at.desc().nulls_last(), AllegroConversation.id)
+            .limit(limit).offset(offset)
+        )).all()
+        covered_since = getattr(sync_state, f"{key}_covered_since")
+        if covered_since is not None and (
+                len(rows) < limit or rows[-1].last_message_at is None or rows[-1].last_message_at <= covered_since):
+            return None
+        return {
+            key: [row.raw for row in rows],
+            "count": len(rows),
+            "offset": offset,
+            "totalCount": max(getattr(sync_state, f"{key}_total_count") or 0, offset + len(rows)),
+            "source": "mirror",
+            "syncedAt": synced_at.isoformat(),
+        }
+
+    async def get_messages(self, account_id: int, kind: str, conversation_id: str,
+                           limit: Optional[int]) -> Optional[dict]:
+        """
+        Последние сообщения диалога или None, если копия неполна. О новой активности в диалоге
+        копия узнает из списка, поэтому и сам список должен быть свежим.
+        """
+        if not self._is_fresh(await self._listing_synced_at(account_id, kind)):
+            return None
+        conversation = await self.db.get(AllegroConversation, (account_id, kind, conversation_id))
+        if conversation is None or conversation.messages_synced_at is None:
+            return None
+        if conversation.last_message_at and conversation.messages_synced_at < conversation.last_message_at:
+            return None
+
+        rows = (await self.db.execute(
+            select(AllegroMessageMirror.raw)
+            .where(
+                AllegroMessageMirror.allegro_account_id == account_id,
+                AllegroMessageMirror.conversation_kind == kind,
+                AllegroMessageMirror.conversation_id == conversation_id,
+            )
+            .order_by(AllegroMessageMirror.created_at.desc().nulls_last())
+            .limit(limit)
+        )).scalars().all()
+        return {
+            "messages": list(rows),
+            "source": "mirror",
+            "syncedAt": conversation.messages_synced_at.isoformat(),
+        }
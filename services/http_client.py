@@ -0,0 +1,48 @@
+# services/http_client.py
+import httpx
+from typing import Optional
+from config import settings
+from utils.logger import logger
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=settings.ALLEGRO_HTTP2,
+        limits=httpx.Limits(
+            max_connections=settings.ALLEGRO_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.ALLEGRO_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=settings.ALLEGRO_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.ALLEGRO_HTTP_TIMEOUT, connect=settings.ALLEGRO_HTTP_CONNECT_TIMEOUT),
+    )
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """Создает общий пул соединений процесса. Вызывать в lifespan приложения и при старте воркера."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _build_http_client()
+        logger.info("Пул HTTP-соединений к Allegro создан", http2=settings.ALLEGRO_HTTP2)
+    return _http_client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Возвращает общий HTTP-клиент. Заголовки авторизации передаются в каждом запросе,
+    поэтому клиент можно разделять между аккаунтами.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        # Страховка для скриптов и тестов, где lifespan не запускался
+        _http_client = _build_http_client()
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logger.info("Пул HTTP-соединений к Allegro закрыт")
+    _http_client = None
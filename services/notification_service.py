@@ -1,9 +1,15 @@
 # services/notification_service.py
+import asyncio
 import firebase_admin
 from firebase_admin import messaging, credentials
 import os
 import json
 import logging
+from typing import List, Set, Tuple
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.database import AsyncSessionLocal
+from config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -40,26 +46,181 @@ def initialize_firebase():
 FIREBASE_ENABLED = initialize_firebase()
 
 
-def send_notification(token: str, title: str, body: str):
-    """Отправляет push-уведомление через Firebase Cloud Messaging."""
-    if not FIREBASE_ENABLED:
-        return
+async def claim_push_slot(db: AsyncSession, token: str, count: int) -> Tuple[bool, int]:
+    """
+    Троттлинг уведомлений на устройство, общий для всех процессов (таблица push_throttle).
+    Атомарно решает, можно ли отправить push на token сейчас. Возвращает (можно, подавлено ранее):
+    если окно PUSH_THROTTLE_SECONDS еще не прошло, count прибавляется к подавленным,
+    и они попадут в следующее сводное уведомление.
+    """
+    stmt = text("""
+        WITH previous AS (
+            SELECT suppressed_count FROM push_throttle WHERE fcm_token = :token FOR UPDATE
+        ), upserted AS (
+            INSERT INTO push_throttle AS p (fcm_token, last_sent_at, suppressed_count)
+            VALUES (:token, NOW(), 0)
+            ON CONFLICT (fcm_token) DO UPDATE SET
+                last_sent_at = CASE
+                    WHEN p.last_sent_at <= NOW() - make_interval(secs => CAST(:window AS integer)) THEN NOW()
+                    ELSE p.last_sent_at
+                END,
+                suppressed_count = CASE
+                    WHEN p.last_sent_at <= NOW() - make_interval(secs => CAST(:window AS integer)) THEN 0
+                    ELSE p.suppressed_count + CAST(:count AS integer)
+                END
+            RETURNING p.last_sent_at = NOW() AS allowed
+        )
+        SELECT upserted.allowed, COALESCE((SELECT suppressed_count FROM previous), 0) AS suppressed
+        FROM upserted;
+    """)
+    row = (await db.execute(stmt, {"token": token, "count": count, "window": settings.PUSH_THROTTLE_SECONDS})).one()
+    return row.allowed, row.suppressed if row.allowed else 0
 
-    if not token:
-        logger.warning("FCM токен отсутствует, отправка уведомления отменена.")
-        return
+async def claim_suppressed_pushes(db: AsyncSession, limit: int) -> List[Tuple[str, int]]:
+    """
+    Забирает устройства, у которых есть подавленные троттлингом уведомления и окно
+    PUSH_THROTTLE_SECONDS уже прошло, и отмечает отправку сводки (как claim_push_slot).
+    Возвращает (token, подавлено). Без этого подавленные уведомления ждали бы следующего
+    нового сообщения, которое может и не прийти.
+    """
+    stmt = text("""
+        WITH due AS (
+            SELECT fcm_token, suppressed_count FROM push_throttle
+            WHERE suppressed_count > 0
+                AND last_sent_at <= NOW() - make_interval(secs => CAST(:window AS integer))
+            ORDER BY last_sent_at
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE push_throttle AS p
+        SET last_sent_at = NOW(), suppressed_count = 0
+        FROM due
+        WHERE p.fcm_token = due.fcm_token
+        RETURNING p.fcm_token, due.suppressed_count;
+    """)
+    result = await db.execute(stmt, {"limit": limit, "window": settings.PUSH_THROTTLE_SECONDS})
+    return [(row.fcm_token, row.suppressed_count) for row in result]
 
-    message = messaging.Message(
-        notification=messaging.Notification(title=title, body=body),
-        token=token,
-    )
 
-    try:
-        response = messaging.send(message)
-        logger.info(f"Push-уведомление отправлено успешно: {response}")
-    except messaging.UnregisteredError:
-        logger.warning(f"FCM токен не зарегистрирован или истек: {token[:15]}...")
-    except messaging.InvalidArgumentError as e:
-        logger.error(f"Некорректные аргументы для отправки push-уведомления: {e}")
-    except Exception as e:
-        logger.error(f"Неизвестная ошибка при отправке push-уведомления: {e}", exc_info=True)
\ No newline at end of file
+class NotificationDispatcher:
+    """
+    Асинхронная очередь push-уведомлений процесса. enqueue() не блокирует цикл событий:
+    уведомления копятся в памяти и уходят пачками через messaging.send_each
+    в отдельном потоке. Токены, которые FCM считает незарегистрированными,
+    очищаются у пользователей одним UPDATE.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue_size: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._stopped = False
+        self.delivered = 0
+        self.failed = 0
+        self.unregistered = 0
+        self.dropped = 0
+
+    def enqueue(self, token: str, title: str, body: str):
+        if not FIREBASE_ENABLED:
+            return
+        if not token:
+            logger.warning("FCM токен отсутствует, отправка уведомления отменена.")
+            return
+        message = messaging.Message(notification=messaging.Notification(title=title, body=body), token=token)
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Очередь push-уведомлений переполнена, уведомление отброшено.")
+
+    async def _next_batch(self) -> List[messaging.Message]:
+        try:
+            batch = [await asyncio.wait_for(self._queue.get(), timeout=self.flush_interval)]
+        except asyncio.TimeoutError:
+            return []
+        # Добираем то, что накопилось за окно flush_interval, но не больше лимита пачки FCM
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _send_batch(self, batch: List[messaging.Message]):
+        try:
+            response = await asyncio.to_thread(messaging.send_each, batch)
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Ошибка при отправке пачки push-уведомлений: {e}", exc_info=True)
+            return
+
+        unregistered_tokens = set()
+        for message, result in zip(batch, response.responses):
+            if result.success:
+                self.delivered += 1
+            elif isinstance(result.exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+                self.unregistered += 1
+                unregistered_tokens.add(message.token)
+            else:
+                self.failed += 1
+                logger.error(f"Не удалось отправить push-уведомление: {result.exception}")
+        logger.info(f"Пачка push-уведомлений отправлена: доставлено {response.success_count}, "
+                    f"ошибок {response.failure_count}, незарегистрированных токенов {len(unregistered_tokens)}.")
+
+        if unregistered_tokens:
+            await self._clear_tokens(unregistered_tokens)
+
+    async def _clear_tokens(self, tokens: Set[str]):
+        try:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    await db.execute(
+                        text("UPDATE users SET fcm_token = NULL WHERE fcm_token = ANY(CAST(:tokens AS text[]))"),
+                        {"tokens": list(tokens)}
+                    )
+        except Exception as e:
+            logger.error(f"Не удалось очистить незарегистрированные FCM токены: {e}")
+
+    async def run(self):
+        """Отправляет уведомления, пока не вызван stop(); затем досылает остаток очереди."""
+        while not (self._stopped and self._queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._send_batch(batch)
+
+    async def flush_suppressed(self) -> int:
+        """Ставит в очередь сводки по подавленным уведомлениям, чье окно троттлинга прошло."""
+        flushed = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    due = await claim_suppressed_pushes(db, self.batch_size)
+            for token, suppressed in due:
+                self.enqueue(token=token, title=f"Nowe wiadomości: {suppressed}",
+                             body="Kliknij, aby odpowiedzieć.")
+            flushed += len(due)
+            if len(due) < self.batch_size:
+                return flushed
+
+    def stop(self):
+        self._stopped = True
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "unregistered": self.unregistered,
+            "dropped": self.dropped,
+        }
+
+
+notification_dispatcher = NotificationDispatcher(
+    batch_size=settings.NOTIFICATION_BATCH_SIZE,
+    flush_interval=settings.NOTIFICATION_FLUSH_INTERVAL,
+    max_queue_size=settings.NOTIFICATION_QUEUE_MAXSIZE,
+)
@@ -0,0 +1,124 @@
+# services/retention_service.py
+import asyncio
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from sqlalchemy import text
+from models.database import AsyncSessionLocal
+from utils.logger import logger
+from config import settings
+
+# Границы партиции по диапазону: FOR VALUES FROM ('...') TO ('...')
+_RANGE_BOUND = re.compile(r"FOR VALUES FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+class RetentionService:
+    """
+    Удаляет устаревшие строки порциями: keyset по колонке времени, каждая порция в своей
+    короткой транзакции и с паузой между порциями, чтобы не держать блокировки и не
+    раздувать WAL. Если таблица партиционирована по времени, старые партиции
+    отсоединяются и удаляются целиком, а порциями дочищается только остаток.
+    """
+
+    def __init__(self, batch_size: int = None, pause_seconds: float = None):
+        self.batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+        self.pause_seconds = settings.RETENTION_BATCH_PAUSE_SECONDS if pause_seconds is None else pause_seconds
+
+    async def purge_auto_reply_log(self) -> dict:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.AUTO_REPLY_LOG_RETENTION_DAYS)
+        return await self.purge("auto_reply_log", "reply_time", cutoff)
+
+    async def purge_message_metadata(self) -> dict:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.MESSAGE_METADATA_RETENTION_DAYS)
+        return await self.purge("message_metadata", "sent_at", cutoff)
+
+    async def purge_auto_reply_outbox(self) -> dict:
+        # Ожидающие и отправляемые ответы не трогаем: удаляются только завершенные
+        cutoff = datetime.now(timezone.utc) - timedelta(days=settings.AUTO_REPLY_OUTBOX_RETENTION_DAYS)
+        return await self.purge("auto_reply_outbox", "created_at", cutoff, condition="status IN ('sent', 'failed')")
+
+    async def purge(self, table: str, time_column: str, cutoff: datetime, condition: Optional[str] = None) -> dict:
+        """
+        Удаляет строки table с time_column < cutoff (и, если задано, удовлетворяющие condition).
+        Возвращает статистику прогона. Партиции целиком удаляются только без condition.
+        """
+        started = time.monotonic()
+        partitions_dropped = [] if condition else await self._drop_expired_partitions(table, cutoff)
+        extra_condition = f" AND {condition}" if condition else ""
+
+        # ctid уникален только внутри одной физической таблицы; у партиционированной таблицы
+        # строки разных партиций могут иметь одинаковый ctid, поэтому сверяем и tableoid
+        stmt = text(f"""
+            WITH batch AS (
+                SELECT tableoid, ctid, {time_column} AS ts FROM {table}
+                WHERE {time_column} >= :after AND {time_column} < :cutoff{extra_condition}
+                ORDER BY {time_column}
+                LIMIT :limit
+            ), deleted AS (
+                DELETE FROM {table} AS t USING batch
+                WHERE t.tableoid = batch.tableoid AND t.ctid = batch.ctid
+                RETURNING batch.ts
+            )
+            SELECT count(*) AS deleted, max(ts) AS last_ts FROM deleted;
+        """)
+        after = datetime.min.replace(tzinfo=timezone.utc)
+        deleted = 0
+        batches = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    row = (await db.execute(stmt, {"after": after, "cutoff": cutoff, "limit": self.batch_size})).one()
+            if not row.deleted:
+                break
+            deleted += row.deleted
+            batches += 1
+            # Следующая порция начинается с последней удаленной метки: строки с тем же временем
+            # уже удалены, а индекс не сканирует заново мертвые строки начала диапазона
+            after = row.last_ts
+            if row.deleted < self.batch_size:
+                break
+            await asyncio.sleep(self.pause_seconds)
+
+        elapsed = time.monotonic() - started
+        stats = {
+            "table": table,
+            "deleted": deleted,
+            "batches": batches,
+            "partitions_dropped": len(partitions_dropped),
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(deleted / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+        logger.info(f"Очистка {table} завершена: удалено {deleted} строк за {elapsed:.1f} с.", **stats)
+        return stats
+
+    async def _drop_expired_partitions(self, table: str, cutoff: datetime) -> List[str]:
+        """Отсоединяет и удаляет партиции, верхняя граница которых не позже cutoff."""
+        async with AsyncSessionLocal() as db:
+            partitions = (await db.execute(text("""
+                SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+                FROM pg_inherits
+                JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+                JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+                JOIN pg_namespace AS ns ON ns.oid = parent.relnamespace
+                JOIN pg_partitioned_table AS pt ON pt.partrelid = parent.oid
+                WHERE parent.relname = :table AND ns.nspname = 'public';
+            """), {"table": table})).all()
+
+        dropped = []
+        for partition in partitions:
+            match = _RANGE_BOUND.search(partition.bound or "")
+            if not match:
+                continue
+            upper = datetime.fromisoformat(match.group(2))
+            if upper.tzinfo is None:
+                upper = upper.replace(tzinfo=timezone.utc)
+            if upper > cutoff:
+                continue
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    await db.execute(text(f'ALTER TABLE {table} DETACH PARTITION "{partition.name}"'))
+                    await db.execute(text(f'DROP TABLE "{partition.name}"'))
+            logger.info(f"Партиция {partition.name} таблицы {table} удалена.", upper_bound=match.group(2))
+            dropped.append(partition.name)
+        return dropped
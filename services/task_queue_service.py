@@ -0,0 +1,252 @@
+# services/task_queue_service.py
+import asyncio
+import asyncpg
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import settings
+from utils.logger import logger
+
+TASK_QUEUE_CHANNEL = "task_queue"
+
+
+class TaskQueueService:
+    """Операции над таблицей task_queue, выполняемые пачками."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def notify(self):
+        """Будит слушающих воркеров. NOTIFY доставляется при коммите транзакции."""
+        await self.db.execute(text("SELECT pg_notify(:channel, '')"), {"channel": TASK_QUEUE_CHANNEL})
+
+    async def enqueue_account(self, account_id: int):
+        """Ставит аккаунт в очередь (если его там нет) и будит воркеров."""
+        await self.db.execute(
+            text("""
+                INSERT INTO task_queue (allegro_account_id, status)
+                VALUES (:acc_id, 'pending')
+                ON CONFLICT (allegro_account_id) DO NOTHING;
+            """),
+            {"acc_id": account_id}
+        )
+        await self.notify()
+
+    async def enqueue_all_accounts(self) -> int:
+        """
+        Одним запросом добавляет в очередь аккаунты, которых там еще нет. Возвращает число добавленных.
+        Существующие строки не трогаются и не блокируются: после выполнения задача сама
+        возвращается в pending со своим next_run_at, поэтому сбрасывать их не нужно.
+        """
+        stmt = text("""
+            INSERT INTO task_queue (allegro_account_id, status)
+            SELECT a.id, 'pending' FROM allegro_accounts AS a
+            WHERE NOT EXISTS (SELECT 1 FROM task_queue AS t WHERE t.allegro_account_id = a.id)
+            ON CONFLICT (allegro_account_id) DO NOTHING;
+        """)
+        result = await self.db.execute(stmt)
+        return result.rowcount
+
+    async def claim_batch(self, limit: int, shard_index: int = 0,
+                          shard_count: int = 1) -> List[Tuple[int, int, datetime]]:
+        """
+        Забирает до limit задач, время которых подошло, и выдает на них аренду.
+        При shard_count > 1 берет только аккаунты своего шарда (allegro_account_id % shard_count),
+        чтобы процессы одного узла не конкурировали за одни и те же строки.
+        """
+        stmt = text("""
+            UPDATE task_queue
+            SET status = 'processing', processed_at = NOW(),
+                locked_until = NOW() + make_interval(secs => CAST(:lease AS integer))
+            WHERE id IN (
+                SELECT id FROM task_queue
+                WHERE status IN ('pending', 'failed') AND next_run_at <= NOW()
+                    AND allegro_account_id % CAST(:shard_count AS integer) = CAST(:shard_index AS integer)
+                ORDER BY next_run_at
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, allegro_account_id, processed_at;
+        """)
+        result = await self.db.execute(stmt, {
+            "limit": limit,
+            "lease": settings.TASK_LEASE_SECONDS,
+            "shard_index": shard_index,
+            "shard_count": shard_count,
+        })
+        return [(row.id, row.allegro_account_id, row.processed_at) for row in result]
+
+    async def seconds_until_next_run(self, shard_index: int = 0, shard_count: int = 1) -> Optional[float]:
+        """Через сколько секунд подойдет ближайшая задача шарда (0, если уже подошла; None - задач нет)."""
+        stmt = text("""
+            SELECT GREATEST(0, EXTRACT(EPOCH FROM (next_run_at - NOW()))) AS wait
+            FROM task_queue
+            WHERE status IN ('pending', 'failed')
+                AND allegro_account_id % CAST(:shard_count AS integer) = CAST(:shard_index AS integer)
+            ORDER BY next_run_at
+            LIMIT 1;
+        """)
+        wait = (await self.db.execute(stmt, {"shard_index": shard_index, "shard_count": shard_count})).scalar()
+        return None if wait is None else float(wait)
+
+    async def extend_leases(self, task_ids: Sequence[int]) -> int:
+        """Продлевает аренду задач, которые еще обрабатываются."""
+        if not task_ids:
+            return 0
+        stmt = text("""
+            UPDATE task_queue
+            SET locked_until = NOW() + make_interval(secs => CAST(:lease AS integer))
+            WHERE id = ANY(CAST(:ids AS integer[])) AND status = 'processing';
+        """)
+        result = await self.db.execute(stmt, {"ids": list(task_ids), "lease": settings.TASK_LEASE_SECONDS})
+        return result.rowcount
+
+    async def reap_expired_leases(self) -> List[int]:
+        """
+        Возвращает в pending задачи, чья аренда истекла (воркер упал или завис).
+        Такой запуск считается неудачной попыткой и откладывается с backoff.
+        """
+        stmt = text("""
+            UPDATE task_queue
+            SET status = 'pending',
+                locked_until = NULL,
+                attempts = attempts + 1,
+                next_run_at = NOW() + make_interval(secs => LEAST(
+                    CAST(:retry_base AS float8) * power(2, attempts),
+                    CAST(:retry_max AS float8)
+                ))
+            WHERE status = 'processing' AND locked_until < NOW()
+            RETURNING id;
+        """)
+        result = await self.db.execute(stmt, {
+            "retry_base": settings.TASK_RETRY_BASE_SECONDS,
+            "retry_max": settings.TASK_RETRY_MAX_SECONDS,
+        })
+        return list(result.scalars().all())
+
+    async def complete_batch(self, results: Sequence[Tuple[int, datetime, str, int]]) -> int:
+        """
+        Записывает итоги задач (id, время взятия, status, новых сообщений) одним UPDATE, снимает
+        аренду и планирует следующий запуск. Аккаунты с новыми сообщениями опрашиваются
+        с минимальным интервалом, у тихих интервал растет до TASK_MAX_INTERVAL_SECONDS.
+        Неудачные задачи откладываются с экспоненциальным backoff по числу попыток.
+        Итог применяется, только если строка все еще в processing по той же аренде
+        (processed_at из claim_batch): задачу, возвращенную reaper и взятую другим воркером,
+        запоздавший итог не трогает. Возвращает число примененных итогов.
+        """
+        if not results:
+            return 0
+        stmt = text("""
+            UPDATE task_queue AS t
+            SET status = CASE WHEN s.failed THEN 'failed' ELSE 'pending' END,
+                attempts = CASE WHEN s.failed THEN s.attempts + 1 ELSE 0 END,
+                poll_interval_seconds = s.interval,
+                locked_until = NULL,
+                next_run_at = NOW() + make_interval(secs => (
+                    CASE
+                        WHEN s.failed THEN LEAST(
+                            CAST(:retry_base AS float8) * power(2, s.attempts),
+                            CAST(:retry_max AS float8)
+                        )
+                        ELSE s.interval
+                    END
+                ) * (0.9 + random() * 0.2))
+            FROM (
+                SELECT
+                    r.id,
+                    r.claimed_at,
+                    r.status = 'failed' AS failed,
+                    q.attempts,
+                    CASE
+                        WHEN r.status = 'failed' THEN q.poll_interval_seconds
+                        WHEN r.new_messages > 0 THEN CAST(:min_interval AS integer)
+                        ELSE LEAST(
+                            CEIL(q.poll_interval_seconds * CAST(:backoff AS float8))::integer,
+                            CAST(:max_interval AS integer)
+                        )
+                    END AS interval
+                FROM unnest(
+                    CAST(:ids AS integer[]),
+                    CAST(:claimed_at AS timestamptz[]),
+                    CAST(:statuses AS varchar[]),
+                    CAST(:new_messages AS integer[])
+                ) AS r(id, claimed_at, status, new_messages)
+                JOIN task_queue AS q ON q.id = r.id
+            ) AS s
+            WHERE t.id = s.id AND t.status = 'processing' AND t.processed_at = s.claimed_at;
+        """)
+        result = await self.db.execute(stmt, {
+            "ids": [task_id for task_id, _, _, _ in results],
+            "claimed_at": [claimed_at for _, claimed_at, _, _ in results],
+            "statuses": [status for _, _, status, _ in results],
+            "new_messages": [new_messages for _, _, _, new_messages in results],
+            "min_interval": settings.TASK_MIN_INTERVAL_SECONDS,
+            "max_interval": settings.TASK_MAX_INTERVAL_SECONDS,
+            "backoff": settings.TASK_INTERVAL_BACKOFF,
+            "retry_base": settings.TASK_RETRY_BASE_SECONDS,
+            "retry_max": settings.TASK_RETRY_MAX_SECONDS,
+        })
+        return result.rowcount
+
+
+class TaskQueueListener:
+    """
+    Держит отдельное соединение с LISTEN на канале task_queue и выставляет
+    wakeup при каждом NOTIFY. При обрыве соединения переподключается.
+    """
+
+    def __init__(self, wakeup: asyncio.Event, dsn: Optional[str] = None):
+        self.wakeup = wakeup
+        self.dsn = dsn or self._asyncpg_dsn(settings.DATABASE_LISTEN_URL or settings.DATABASE_URL)
+        self._stopped = asyncio.Event()
+
+    @staticmethod
+    def _asyncpg_dsn(url: str) -> str:
+        return make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.wakeup.set()
+
+    async def run(self):
+        retry_delay = 1
+        while not self._stopped.is_set():
+            connection_lost = asyncio.Event()
+            try:
+                connection = await asyncpg.connect(self.dsn, statement_cache_size=0)
+            except Exception as e:
+                logger.warning(f"Не удалось открыть LISTEN-соединение, работаем на опросе. Детали: {e}")
+                await self._sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+                continue
+
+            try:
+                connection.add_termination_listener(lambda _, lost=connection_lost: lost.set())
+                await connection.add_listener(TASK_QUEUE_CHANNEL, self._on_notify)
+                logger.info("LISTEN task_queue активен.")
+                retry_delay = 1
+                # Пока соединения не было, NOTIFY могли потеряться - проверяем очередь сразу
+                self.wakeup.set()
+                stop_waiter = asyncio.create_task(self._stopped.wait())
+                lost_waiter = asyncio.create_task(connection_lost.wait())
+                await asyncio.wait({stop_waiter, lost_waiter}, return_when=asyncio.FIRST_COMPLETED)
+                stop_waiter.cancel()
+                lost_waiter.cancel()
+                if connection_lost.is_set():
+                    logger.warning("LISTEN-соединение потеряно, переподключаемся.")
+            except Exception as e:
+                logger.warning(f"Ошибка LISTEN-соединения, переподключаемся. Детали: {e}")
+                await self._sleep(retry_delay)
+            finally:
+                if not connection.is_closed():
+                    await connection.close()
+
+    async def _sleep(self, delay: float):
+        try:
+            await asyncio.wait_for(self._stopped.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        self._stopped.set()
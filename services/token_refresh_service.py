@@ -0,0 +1,63 @@
+# services/token_refresh_service.py
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from sqlalchemy import select
+from models.models import AllegroAccount
+from models.database import AsyncSessionLocal
+from services.allegro_client import refresh_account_tokens
+from utils.logger import logger
+from config import settings
+
+
+class TokenRefreshService:
+    """
+    Заранее обновляет токены аккаунтов, срок действия которых истекает в ближайшее окно,
+    чтобы первый запрос пользователя после истечения не платил за 401 и обновление.
+    Каждое обновление идет тем же single-flight путем, что и в AllegroClient, поэтому
+    задача может одновременно работать на нескольких инстансах и рядом с воркерами.
+    """
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(settings.TOKEN_REFRESH_CONCURRENCY)
+
+    async def refresh_expiring_tokens(self) -> dict:
+        """Постранично (keyset по id) обновляет истекающие токены. Возвращает счетчики."""
+        deadline = datetime.now(timezone.utc) + timedelta(minutes=settings.TOKEN_REFRESH_WINDOW_MINUTES)
+        stats = {"refreshed": 0, "failed": 0, "skipped": 0}
+        last_id = 0
+
+        while True:
+            async with AsyncSessionLocal() as db:
+                page = (await db.execute(
+                    select(AllegroAccount.id, AllegroAccount.access_token)
+                    .where(AllegroAccount.expires_at < deadline, AllegroAccount.id > last_id)
+                    .order_by(AllegroAccount.id)
+                    .limit(settings.TOKEN_REFRESH_PAGE_SIZE)
+                )).all()
+            if not page:
+                break
+            last_id = page[-1].id
+
+            results = await asyncio.gather(*(self._refresh_one(row.id, row.access_token) for row in page))
+            for result in results:
+                stats[result] += 1
+
+        return stats
+
+    async def _refresh_one(self, account_id: int, access_token: str) -> str:
+        # Размазываем обновления по времени, чтобы не бить в Allegro пачкой
+        await asyncio.sleep(random.uniform(0, settings.TOKEN_REFRESH_SPREAD_SECONDS))
+        async with self.semaphore:
+            try:
+                tokens: Optional[dict] = await refresh_account_tokens(account_id, access_token)
+            except Exception as e:
+                logger.error("Ошибка при фоновом обновлении токена", account_id=account_id, details=str(e))
+                return "failed"
+
+        if tokens is None:
+            logger.warning("Фоновое обновление токена не удалось", account_id=account_id)
+            return "failed"
+        # Токен успели обновить запрос пользователя, воркер или другой инстанс
+        return "refreshed" if tokens["refreshed"] else "skipped"
@@ -0,0 +1,15 @@
+-- Планирование опроса аккаунтов: у каждой задачи свое время следующего запуска и интервал
+ALTER TABLE public.task_queue
+ADD COLUMN IF NOT EXISTS next_run_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+ADD COLUMN IF NOT EXISTS poll_interval_seconds INT NOT NULL DEFAULT 300;
+
+-- Задачи, завершенные до появления планирования, снова становятся ожидающими
+UPDATE public.task_queue SET status = 'pending', next_run_at = NOW() WHERE status = 'done';
+
+-- Индекс для выборки задач, время которых подошло
+CREATE INDEX IF NOT EXISTS idx_task_queue_due ON public.task_queue (next_run_at)
+    WHERE status IN ('pending', 'failed');
+
+COMMENT ON COLUMN public.task_queue.next_run_at IS 'Время, начиная с которого задачу можно взять в обработку';
+COMMENT ON COLUMN public.task_queue.poll_interval_seconds IS 'Текущий адаптивный интервал опроса аккаунта в секундах';
+COMMENT ON COLUMN public.task_queue.status IS 'Статус задачи: pending, processing, failed';
@@ -0,0 +1,15 @@
+-- Аренда задач: воркер продлевает locked_until, пока обрабатывает аккаунт.
+-- Истекшая аренда означает, что воркер упал, и задачу можно вернуть в очередь.
+ALTER TABLE public.task_queue
+ADD COLUMN IF NOT EXISTS locked_until TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+
+-- Индекс для поиска задач с истекшей арендой
+CREATE INDEX IF NOT EXISTS idx_task_queue_lease ON public.task_queue (locked_until)
+    WHERE status = 'processing';
+
+-- Задачи, зависшие в processing до появления аренды, возвращаем в очередь
+UPDATE public.task_queue SET status = 'pending', next_run_at = NOW() WHERE status = 'processing';
+
+COMMENT ON COLUMN public.task_queue.locked_until IS 'До какого момента задача закреплена за воркером';
+COMMENT ON COLUMN public.task_queue.attempts IS 'Количество неудачных попыток подряд';
@@ -0,0 +1,16 @@
+-- Курсор инкрементальной синхронизации диалогов по каждому аккаунту
+CREATE TABLE IF NOT EXISTS public.account_sync_state (
+    allegro_account_id INT PRIMARY KEY,
+    last_message_at    TIMESTAMPTZ,
+    last_thread_ids    TEXT[] NOT NULL DEFAULT '{}',
+    updated_at         TIMESTAMPTZ DEFAULT NOW(),
+
+    CONSTRAINT fk_allegro_account
+        FOREIGN KEY(allegro_account_id)
+        REFERENCES public.allegro_accounts(id)
+        ON DELETE CASCADE
+);
+
+COMMENT ON TABLE public.account_sync_state IS 'Водяной знак синхронизации диалогов Allegro по аккаунту';
+COMMENT ON COLUMN public.account_sync_state.last_message_at IS 'Самый новый lastMessageDateTime, обработанный воркером';
+COMMENT ON COLUMN public.account_sync_state.last_thread_ids IS 'Диалоги с lastMessageDateTime, равным водяному знаку';
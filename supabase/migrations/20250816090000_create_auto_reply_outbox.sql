@@ -0,0 +1,33 @@
+-- Outbox автоответов: опрос аккаунтов только записывает намерение ответить
+-- (в той же транзакции, что и auto_reply_log), а отправкой занимается отдельный этап воркера.
+CREATE TABLE IF NOT EXISTS public.auto_reply_outbox (
+    id                 BIGSERIAL PRIMARY KEY,
+    allegro_account_id INT NOT NULL,
+    thread_id          TEXT NOT NULL,
+    body               TEXT NOT NULL,
+    idempotency_key    TEXT NOT NULL UNIQUE,
+    status             TEXT NOT NULL DEFAULT 'pending',
+    attempts           INT NOT NULL DEFAULT 0,
+    next_attempt_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    locked_until       TIMESTAMPTZ,
+    last_error         TEXT,
+    created_at         TIMESTAMPTZ DEFAULT NOW(),
+    sent_at            TIMESTAMPTZ,
+
+    CONSTRAINT fk_allegro_account
+        FOREIGN KEY(allegro_account_id)
+        REFERENCES public.allegro_accounts(id)
+        ON DELETE CASCADE
+);
+
+-- Индекс для выборки ответов, готовых к отправке
+CREATE INDEX IF NOT EXISTS idx_auto_reply_outbox_ready ON public.auto_reply_outbox (next_attempt_at)
+    WHERE status = 'pending';
+
+-- Индекс для возврата ответов, отправитель которых упал
+CREATE INDEX IF NOT EXISTS idx_auto_reply_outbox_lease ON public.auto_reply_outbox (locked_until)
+    WHERE status = 'sending';
+
+COMMENT ON TABLE public.auto_reply_outbox IS 'Очередь автоответов на отправку в Allegro';
+COMMENT ON COLUMN public.auto_reply_outbox.idempotency_key IS 'Аккаунт, диалог и время сообщения покупателя: один ответ на одно сообщение';
+COMMENT ON COLUMN public.auto_reply_outbox.status IS 'pending, sending, sent или failed (попытки исчерпаны)';
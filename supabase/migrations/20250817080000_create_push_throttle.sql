@@ -0,0 +1,9 @@
+-- Троттлинг push-уведомлений на устройство, общий для всех процессов воркера
+CREATE TABLE IF NOT EXISTS public.push_throttle (
+    fcm_token        TEXT PRIMARY KEY,
+    last_sent_at     TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    suppressed_count INT NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE public.push_throttle IS 'Когда на устройство последний раз уходило push-уведомление';
+COMMENT ON COLUMN public.push_throttle.suppressed_count IS 'Новые сообщения, о которых не уведомили из-за троттлинга';
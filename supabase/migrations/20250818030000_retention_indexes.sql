@@ -0,0 +1,3 @@
+-- Индексы для порционной очистки по времени: без них каждая порция сканирует всю таблицу
+CREATE INDEX IF NOT EXISTS idx_auto_reply_log_reply_time ON public.auto_reply_log (reply_time);
+CREATE INDEX IF NOT EXISTS idx_message_metadata_sent_at ON public.message_metadata (sent_at);
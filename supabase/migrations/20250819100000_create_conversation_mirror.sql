@@ -0,0 +1,53 @@
+-- Локальная копия диалогов, обсуждений и сообщений Allegro для эндпоинтов чтения.
+-- Заполняется циклом опроса воркера, отправками и запросами, ушедшими в Allegro напрямую.
+CREATE TABLE IF NOT EXISTS public.allegro_conversations (
+    allegro_account_id INT NOT NULL,
+    kind               TEXT NOT NULL,
+    id                 TEXT NOT NULL,
+    last_message_at    TIMESTAMPTZ,
+    read               BOOLEAN,
+    raw                JSONB NOT NULL,
+    synced_at          TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    messages_synced_at TIMESTAMPTZ,
+
+    PRIMARY KEY (allegro_account_id, kind, id),
+    CONSTRAINT fk_allegro_account
+        FOREIGN KEY(allegro_account_id)
+        REFERENCES public.allegro_accounts(id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_allegro_conversations_recent
+    ON public.allegro_conversations (allegro_account_id, kind, last_message_at DESC);
+
+CREATE TABLE IF NOT EXISTS public.allegro_messages (
+    allegro_account_id INT NOT NULL,
+    id                 TEXT NOT NULL,
+    conversation_kind  TEXT NOT NULL,
+    conversation_id    TEXT NOT NULL,
+    created_at         TIMESTAMPTZ,
+    author_login       TEXT,
+    text               TEXT,
+    raw                JSONB NOT NULL,
+    synced_at          TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    PRIMARY KEY (allegro_account_id, id),
+    CONSTRAINT fk_allegro_account
+        FOREIGN KEY(allegro_account_id)
+        REFERENCES public.allegro_accounts(id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_allegro_messages_conversation
+    ON public.allegro_messages (allegro_account_id, conversation_kind, conversation_id, created_at DESC);
+
+-- Свежесть списков диалогов и обсуждений по аккаунту
+ALTER TABLE public.account_sync_state
+ADD COLUMN IF NOT EXISTS threads_synced_at TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS threads_total_count INT,
+ADD COLUMN IF NOT EXISTS issues_synced_at TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS issues_total_count INT;
+
+COMMENT ON TABLE public.allegro_conversations IS 'Копия диалогов (thread) и обсуждений (issue) Allegro';
+COMMENT ON COLUMN public.allegro_conversations.messages_synced_at IS 'Когда последняя страница сообщений была синхронизирована полностью';
+COMMENT ON TABLE public.allegro_messages IS 'Копия сообщений диалогов и обсуждений Allegro';
@@ -0,0 +1,16 @@
+-- Полнотекстовый поиск по локальной копии сообщений.
+-- Конфигурация 'simple': в стандартной поставке Postgres нет словаря для польского,
+-- а логины покупателей и номера заказов не должны проходить через стемминг.
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+ALTER TABLE public.allegro_messages
+ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('simple', coalesce(author_login, '')), 'A') ||
+    setweight(to_tsvector('simple',
+        coalesce(raw #>> '{relatesTo,order,id}', '') || ' ' || coalesce(raw #>> '{relatesTo,offer,id}', '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(text, '')), 'B')
+) STORED;
+
+-- Составной GIN-индекс: фильтр по аккаунту и поиск по словам одним сканированием
+CREATE INDEX IF NOT EXISTS idx_allegro_messages_search
+    ON public.allegro_messages USING GIN (allegro_account_id, search_vector);
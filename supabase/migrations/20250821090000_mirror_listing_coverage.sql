@@ -0,0 +1,7 @@
+-- Окно списка, покрытое последним проходом воркера: локальная копия отдает только его
+ALTER TABLE public.account_sync_state
+ADD COLUMN IF NOT EXISTS threads_covered_since TIMESTAMPTZ,
+ADD COLUMN IF NOT EXISTS issues_covered_since TIMESTAMPTZ;
+
+COMMENT ON COLUMN public.account_sync_state.threads_covered_since IS 'Диалоги новее этой границы актуальны на threads_synced_at; NULL - весь список';
+COMMENT ON COLUMN public.account_sync_state.issues_covered_since IS 'Обсуждения новее этой границы актуальны на issues_synced_at; NULL - весь список';
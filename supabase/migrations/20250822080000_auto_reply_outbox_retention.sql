@@ -0,0 +1,3 @@
+-- Индекс для порционной очистки завершенных записей outbox по времени
+CREATE INDEX IF NOT EXISTS idx_auto_reply_outbox_finished_created_at ON public.auto_reply_outbox (created_at)
+    WHERE status IN ('sent', 'failed');
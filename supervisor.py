@@ -0,0 +1,123 @@
+# supervisor.py
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+from config import settings
+from utils.logger import logger
+import worker
+
+RESTART_BACKOFF_MAX = 30
+
+
+class WorkerSupervisor:
+    """
+    Запускает по процессу воркера на ядро, делит между ними аккаунты по шардам
+    и перезапускает упавшие процессы с нарастающей задержкой.
+    """
+
+    def __init__(self, processes: int, concurrency: int, use_uvloop: bool):
+        self.processes = processes
+        self.concurrency = concurrency
+        self.use_uvloop = use_uvloop
+        self.context = multiprocessing.get_context("spawn")
+        self.children: dict[int, multiprocessing.Process] = {}
+        self.restarts: dict[int, int] = {}
+        self.restart_at: dict[int, float] = {}
+        self.stopping = False
+
+    def _start_child(self, shard_index: int):
+        process = self.context.Process(
+            target=worker.run,
+            kwargs={
+                "concurrency": self.concurrency,
+                "shard_index": shard_index,
+                "shard_count": self.processes,
+                "use_uvloop": self.use_uvloop,
+            },
+            name=f"worker-{shard_index}",
+        )
+        process.start()
+        self.children[shard_index] = process
+        self.restart_at.pop(shard_index, None)
+        logger.info(f"Запущен процесс воркера шарда {shard_index}", pid=process.pid)
+
+    def _handle_signal(self, sig, frame):
+        logger.info(f"Супервизор получил сигнал {sig}. Останавливаем воркеры...")
+        self.stopping = True
+
+    def _check_children(self):
+        now = time.monotonic()
+        for shard_index, process in list(self.children.items()):
+            if process.is_alive():
+                continue
+            if shard_index not in self.restart_at:
+                self.restarts[shard_index] = self.restarts.get(shard_index, 0) + 1
+                delay = min(2 ** (self.restarts[shard_index] - 1), RESTART_BACKOFF_MAX)
+                self.restart_at[shard_index] = now + delay
+                logger.error(f"Процесс воркера шарда {shard_index} завершился с кодом {process.exitcode}. "
+                             f"Перезапуск через {delay} с.")
+            elif now >= self.restart_at[shard_index]:
+                self._start_child(shard_index)
+
+    def _shutdown(self) -> int:
+        for process in self.children.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + settings.WORKER_SHUTDOWN_TIMEOUT + 5
+        for process in self.children.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+
+        failed = []
+        for shard_index, process in self.children.items():
+            if process.is_alive():
+                logger.warning(f"Процесс воркера шарда {shard_index} не завершился вовремя, принудительно убиваем.")
+                process.kill()
+                process.join()
+            if process.exitcode != 0:
+                failed.append(shard_index)
+
+        if failed:
+            logger.warning(f"Воркеры завершились с ошибкой: шарды {failed}.")
+            return 1
+        logger.info("Все воркеры завершились штатно.")
+        return 0
+
+    def run(self) -> int:
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+        for shard_index in range(self.processes):
+            self._start_child(shard_index)
+
+        while not self.stopping:
+            time.sleep(1)
+            self._check_children()
+
+        return self._shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Супервизор процессов воркера Allegro Connect")
+    parser.add_argument(
+        "--processes", type=int, default=settings.WORKER_PROCESSES or os.cpu_count() or 1,
+        help="Количество процессов воркера (по умолчанию - по числу ядер)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=settings.WORKER_CONCURRENCY,
+        help="Сколько аккаунтов обрабатывает одновременно каждый процесс"
+    )
+    parser.add_argument("--uvloop", action="store_true", default=settings.WORKER_USE_UVLOOP,
+                        help="Использовать uvloop в процессах воркера")
+    args = parser.parse_args()
+    if args.processes < 1 or args.concurrency < 1:
+        parser.error("--processes и --concurrency должны быть >= 1")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    supervisor = WorkerSupervisor(processes=args.processes, concurrency=args.concurrency, use_uvloop=args.uvloop)
+    raise SystemExit(supervisor.run())
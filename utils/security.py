@@ -1,4 +1,6 @@
+import hashlib
 import hmac
+from cachetools import TTLCache
 from cryptography.fernet import Fernet
 from passlib.context import CryptContext
 from config import settings
@@ -33,4 +35,44 @@ def decrypt_data(encrypted_data: str) -> str:
     """Расшифровывает строку."""
     if not isinstance(encrypted_data, str):
         raise TypeError("Данные для расшифровки должны быть строкой")
-    return fernet.decrypt(encrypted_data.encode()).decode()
\ No newline at end of file
+    return fernet.decrypt(encrypted_data.encode()).decode()
+
+# --- Кеш расшифрованных токенов Allegro ---
+class DecryptedTokenCache:
+    """
+    Ограниченный TTL-кеш расшифрованных токенов. Запись хранится по (id аккаунта, вид токена)
+    вместе с отпечатком шифротекста: если шифротекст сменился (токен обновили),
+    запись считается промахом и перезаписывается.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _fingerprint(encrypted_data: str) -> bytes:
+        return hashlib.blake2b(encrypted_data.encode(), digest_size=16).digest()
+
+    def decrypt(self, account_id: int, encrypted_data: str, kind: str = "access") -> str:
+        fingerprint = self._fingerprint(encrypted_data)
+        key = (account_id, kind)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        value = decrypt_data(encrypted_data)
+        self._cache[key] = (fingerprint, value)
+        return value
+
+    def invalidate(self, account_id: int):
+        for kind in ("access", "refresh"):
+            self._cache.pop((account_id, kind), None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+token_cache = DecryptedTokenCache(maxsize=settings.TOKEN_CACHE_MAXSIZE, ttl=settings.TOKEN_CACHE_TTL_SECONDS)
@@ -1,97 +1,330 @@
 # worker.py
+import argparse
 import asyncio
-import logging
+import random
 import signal
 import os
-from sqlalchemy import text
+from datetime import datetime
 from config import settings
 from services.auto_responder_service import AutoResponderService
+from services.task_queue_service import TaskQueueService, TaskQueueListener
+from services.auto_reply_outbox_service import AutoReplySender
+from services.http_client import init_http_client, close_http_client
+from services.notification_service import notification_dispatcher
 from models.database import AsyncSessionLocal
+from utils.logger import logger
 
 print(f"WORKER SEES DATABASE_URL: {os.getenv('DATABASE_URL')}")
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - WORKER - %(levelname)s - %(message)s")
-logger = logging.getLogger(__name__)
-
 shutdown_event = asyncio.Event()
+work_available = asyncio.Event()
+replies_available = asyncio.Event()
+active_task_ids: set[int] = set()
 
-def handle_shutdown_signal(sig, frame):
+def handle_shutdown_signal(sig):
     logger.info(f"Получен сигнал {sig}. Инициирую вежливое завершение...")
     shutdown_event.set()
+    work_available.set()
+    replies_available.set()
+
+async def wait_for_shutdown(timeout: float):
+    """Спит до timeout секунд, но просыпается сразу при сигнале завершения."""
+    try:
+        await asyncio.wait_for(shutdown_event.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def seconds_until_next_task(shard_index: int, shard_count: int):
+    async with AsyncSessionLocal() as db:
+        return await TaskQueueService(db).seconds_until_next_run(shard_index, shard_count)
 
-async def get_next_task(db):
-    stmt = text("""
-        UPDATE task_queue 
-        SET status = 'processing', processed_at = NOW()
-        WHERE id = (
-            SELECT id FROM task_queue 
-            WHERE status = 'pending' 
-            ORDER BY created_at 
-            LIMIT 1 
-            FOR UPDATE SKIP LOCKED
-        )
-        RETURNING id, allegro_account_id;
-    """)
-    result = await db.execute(stmt)
-    return result.fetchone()
-
-
-async def main_loop():
-    logger.info("Воркер запущен и готов к работе.")
 
+async def wait_for_work(idle_polls: int, shard_index: int, shard_count: int):
+    """
+    Спит до next_run_at ближайшей задачи шарда (не дольше WORKER_POLL_MAX_INTERVAL)
+    или до NOTIFY о новых задачах. Если узнать время не удалось, интервал растет
+    экспоненциально с каждым пустым опросом.
+    """
+    try:
+        next_run = await seconds_until_next_task(shard_index, shard_count)
+        delay = settings.WORKER_POLL_MAX_INTERVAL if next_run is None else next_run
+        # Небольшой пол и джиттер, чтобы процессы не опрашивали очередь хором и не крутились вхолостую
+        delay = min(settings.WORKER_POLL_MAX_INTERVAL, max(delay, 0.1)) + random.uniform(0, 0.2)
+    except Exception as e:
+        logger.warning(f"Не удалось узнать время следующей задачи. Детали: {str(e)}")
+        # Показатель ограничен: без этого 2 ** idle_polls на долго простаивающем шарде переполняет float
+        delay = min(settings.WORKER_POLL_MAX_INTERVAL, settings.WORKER_POLL_MIN_INTERVAL * 2 ** min(idle_polls, 16))
+        delay *= random.uniform(0.5, 1.0)
+    try:
+        await asyncio.wait_for(work_available.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+    work_available.clear()
+
+
+async def acquire_slot(semaphore: asyncio.Semaphore) -> bool:
+    """Ждет свободный слот обработки. Возвращает False, если пришел сигнал завершения."""
     while not shutdown_event.is_set():
-        async with AsyncSessionLocal() as db:
-            async with db.begin():
-                try:
-                    stmt = text("""
-                        UPDATE task_queue
-                        SET status = 'processing', processed_at = NOW()
-                        WHERE id = (
-                            SELECT id FROM task_queue
-                            WHERE status = 'pending'
-                            ORDER BY created_at
-                            LIMIT 1
-                            FOR UPDATE SKIP LOCKED
-                        )
-                        RETURNING id, allegro_account_id;
-                    """)
-                    result = await db.execute(stmt)
-                    task = result.fetchone()
-
-                    if task:
-                        task_id, account_id = task
-                        logger.info(f"Взял в обработку задачу #{task_id}", task_id=task_id, account_id=account_id)
-
-                        service = AutoResponderService(db=db)
-                        await service.process_single_account(account_id)
-
-                        await db.execute(
-                            text("UPDATE task_queue SET status = 'done' WHERE id = :id"),
-                            {"id": task_id}
-                        )
-                        logger.info(f"Задача #{task_id} успешно завершена.", task_id=task_id)
-
-                    else:
-                        pass
-
-                except Exception as e:
-                    logger.error(f"Критическая ошибка при обработке задачи. Откатываем транзакцию. Детали: {str(e)}", exc_info=True)
-                    if 'task_id' in locals():
-                        await db.execute(
-                            text("UPDATE task_queue SET status = 'failed' WHERE id = :id"),
-                            {"id": task_id}
-                        )
-                    await asyncio.sleep(5)
-
-        if not 'task' in locals() or not task:
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=1)
+            return True
+        except asyncio.TimeoutError:
+            continue
+    return False
+
+
+async def claim_tasks(limit: int, shard_index: int, shard_count: int):
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            return await TaskQueueService(db).claim_batch(limit, shard_index, shard_count)
+
+
+class TaskStatusBuffer:
+    """Копит итоговые статусы задач и записывает их в task_queue одной пачкой."""
+
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._results: list[tuple[int, datetime, str, int]] = []
+        self._flush_requested = asyncio.Event()
+
+    def add(self, task_id: int, claimed_at: datetime, status: str, new_messages: int = 0):
+        self._results.append((task_id, claimed_at, status, new_messages))
+        if len(self._results) >= self.flush_size:
+            self._flush_requested.set()
+
+    async def flush(self):
+        if not self._results:
+            return
+        results, self._results = self._results, []
+        try:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    applied = await TaskQueueService(db).complete_batch(results)
+        except Exception as e:
+            logger.error(f"Не удалось записать статусы {len(results)} задач. Повторим позже.", details=str(e))
+            self._results[:0] = results
+            return
+        if applied < len(results):
+            logger.warning(f"Пропущено {len(results) - applied} итогов задач: аренда уже истекла "
+                           f"и задачу взял другой воркер.")
+
+    async def run(self):
+        while not shutdown_event.is_set():
             try:
-                await asyncio.wait_for(shutdown_event.wait(), timeout=10)
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
             except asyncio.TimeoutError:
                 pass
+            self._flush_requested.clear()
+            await self.flush()
+
+
+async def process_task(task_id: int, account_id: int, claimed_at: datetime, statuses: TaskStatusBuffer):
+    """
+    Обрабатывает одну задачу в собственной сессии БД. Транзакциями управляет сервис:
+    соединение берется только на короткие фазы чтения и записи.
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            service = AutoResponderService(db=db)
+            new_messages = await service.process_single_account(account_id)
+            statuses.add(task_id, claimed_at, 'done', new_messages)
+            if new_messages:
+                replies_available.set()
+            logger.info(f"Задача #{task_id} успешно завершена.", task_id=task_id)
+        except Exception as e:
+            logger.error(f"Критическая ошибка при обработке задачи. Детали: {str(e)}",
+                         task_id=task_id, exc_info=True)
+            statuses.add(task_id, claimed_at, 'failed')
+
+
+async def run_task(task_id: int, account_id: int, claimed_at: datetime, semaphore: asyncio.Semaphore,
+                   statuses: TaskStatusBuffer):
+    active_task_ids.add(task_id)
+    try:
+        await process_task(task_id, account_id, claimed_at, statuses)
+    finally:
+        active_task_ids.discard(task_id)
+        semaphore.release()
+
 
+async def renew_leases():
+    """Продлевает аренду всех задач в работе одним UPDATE. Останавливается отменой после drain."""
+    while True:
+        await asyncio.sleep(settings.TASK_LEASE_SECONDS / 3)
+        if not active_task_ids:
+            continue
+        try:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    await TaskQueueService(db).extend_leases(list(active_task_ids))
+        except Exception as e:
+            logger.warning(f"Не удалось продлить аренду задач. Детали: {str(e)}")
+
+
+async def reap_expired_leases():
+    """Периодически возвращает в очередь задачи упавших воркеров."""
+    while not shutdown_event.is_set():
+        try:
+            async with AsyncSessionLocal() as db:
+                async with db.begin():
+                    reaped = await TaskQueueService(db).reap_expired_leases()
+            if reaped:
+                logger.warning(f"Возвращено в очередь {len(reaped)} задач с истекшей арендой.", task_ids=reaped)
+        except Exception as e:
+            logger.error(f"Ошибка при возврате задач с истекшей арендой. Детали: {str(e)}")
+        await wait_for_shutdown(settings.WORKER_REAPER_INTERVAL)
+
+
+async def flush_suppressed_pushes():
+    """Периодически досылает сводки по уведомлениям, подавленным троттлингом."""
+    while not shutdown_event.is_set():
+        try:
+            flushed = await notification_dispatcher.flush_suppressed()
+            if flushed:
+                logger.info(f"Отправлено {flushed} сводок по подавленным push-уведомлениям.")
+        except Exception as e:
+            logger.error(f"Ошибка при отправке подавленных push-уведомлений. Детали: {str(e)}")
+        await wait_for_shutdown(settings.PUSH_THROTTLE_SECONDS)
+
+
+async def send_auto_replies(shard_index: int, shard_count: int):
+    """
+    Отправляет автоответы из outbox. Опрос аккаунтов на отправку не ждет: ответы
+    уходят отсюда пачками. При завершении досылается уже взятая пачка, остальное
+    дождется в outbox следующего запуска.
+    """
+    sender = AutoReplySender(shard_index, shard_count)
+    while not shutdown_event.is_set():
+        try:
+            claimed = await sender.send_pending()
+        except Exception as e:
+            logger.error(f"Ошибка при отправке автоответов из outbox. Детали: {str(e)}", exc_info=True)
+            claimed = 0
+        if claimed < settings.AUTO_REPLY_OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(replies_available.wait(), timeout=settings.AUTO_REPLY_OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            replies_available.clear()
+
+
+async def drain(in_flight: set):
+    """Дожидается завершения задач в работе, не дольше WORKER_SHUTDOWN_TIMEOUT."""
+    if not in_flight:
+        return
+    logger.info(f"Ожидаем завершения {len(in_flight)} задач в работе...")
+    done, pending = await asyncio.wait(in_flight, timeout=settings.WORKER_SHUTDOWN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.warning(f"Прервано {len(pending)} задач по таймауту завершения.")
+
+
+async def main_loop(concurrency: int = 1, shard_index: int = 0, shard_count: int = 1):
+    logger.info(f"Воркер запущен и готов к работе. Параллельных задач: {concurrency}, "
+                f"шард {shard_index + 1} из {shard_count}.")
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, handle_shutdown_signal, sig)
+
+    await init_http_client()
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight: set[asyncio.Task] = set()
+    statuses = TaskStatusBuffer(
+        flush_size=settings.WORKER_CLAIM_BATCH_SIZE,
+        flush_interval=settings.WORKER_STATUS_FLUSH_INTERVAL
+    )
+    status_flusher = asyncio.create_task(statuses.run())
+    listener = TaskQueueListener(wakeup=work_available)
+    lease_renewer = asyncio.create_task(renew_leases())
+    background = [asyncio.create_task(listener.run())]
+    reply_sender = asyncio.create_task(send_auto_replies(shard_index, shard_count))
+    push_sender = asyncio.create_task(notification_dispatcher.run())
+    if shard_index == 0:
+        # Истекшие аренды и подавленные уведомления всех шардов обрабатывает один процесс на узел
+        background.append(asyncio.create_task(reap_expired_leases()))
+        background.append(asyncio.create_task(flush_suppressed_pushes()))
+    idle_polls = 0
+
+    while await acquire_slot(semaphore):
+        # Добираем столько свободных слотов, сколько доступно прямо сейчас, чтобы забрать задачи пачкой
+        slots = 1
+        while slots < settings.WORKER_CLAIM_BATCH_SIZE and not semaphore.locked():
+            await semaphore.acquire()
+            slots += 1
+
+        try:
+            tasks = await claim_tasks(slots, shard_index, shard_count)
+        except Exception as e:
+            for _ in range(slots):
+                semaphore.release()
+            logger.error(f"Не удалось получить задачи из очереди. Детали: {str(e)}", exc_info=True)
+            await wait_for_shutdown(5)
+            continue
+
+        for _ in range(slots - len(tasks)):
+            semaphore.release()
+
+        if not tasks:
+            await wait_for_work(idle_polls, shard_index, shard_count)
+            idle_polls += 1
+            continue
+
+        idle_polls = 0
+
+        for task_id, account_id, claimed_at in tasks:
+            logger.info(f"Взял в обработку задачу #{task_id}", task_id=task_id, account_id=account_id)
+            worker_task = asyncio.create_task(run_task(task_id, account_id, claimed_at, semaphore, statuses))
+            in_flight.add(worker_task)
+            worker_task.add_done_callback(in_flight.discard)
+
+    listener.stop()
+    await drain(in_flight)
+    lease_renewer.cancel()
+    await asyncio.gather(lease_renewer, *background, return_exceptions=True)
+    await reply_sender
+    notification_dispatcher.stop()
+    await push_sender
+    logger.info("Итоги отправки push-уведомлений", **notification_dispatcher.stats())
+    await status_flusher
+    await statuses.flush()
+    await close_http_client()
     logger.info("Воркер завершает работу.")
 
+
+def run(concurrency: int, shard_index: int = 0, shard_count: int = 1, use_uvloop: bool = False):
+    """Точка входа процесса воркера (используется и supervisor.py)."""
+    if use_uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logger.warning("uvloop не установлен, используем стандартный цикл событий.")
+    asyncio.run(main_loop(concurrency=concurrency, shard_index=shard_index, shard_count=shard_count))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воркер очереди задач Allegro Connect")
+    parser.add_argument(
+        "--concurrency", type=int, default=settings.WORKER_CONCURRENCY,
+        help="Сколько аккаунтов обрабатывать одновременно"
+    )
+    parser.add_argument("--shard-index", type=int, default=0, help="Номер шарда этого процесса (с нуля)")
+    parser.add_argument("--shard-count", type=int, default=1, help="Общее количество шардов")
+    parser.add_argument("--uvloop", action="store_true", default=settings.WORKER_USE_UVLOOP,
+                        help="Использовать uvloop")
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency должен быть >= 1")
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index должен быть в диапазоне [0, --shard-count)")
+    return args
+
+
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, handle_shutdown_signal)
-    signal.signal(signal.SIGTERM, handle_shutdown_signal)
-    asyncio.run(main_loop())
\ No newline at end of file
+    args = parse_args()
+    run(args.concurrency, args.shard_index, args.shard_count, args.uvloop)